@@ -0,0 +1,253 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import time
+import timeit
+import tracemalloc
+
+import numpy as np
+
+from city_map import make_map
+from fleet import Fleet
+from mesoscopic import LinkQueueSimulation
+from random_streams import RandomStreams
+from simulation import Simulation
+from traffic_light import TrafficLight
+from vehicle_agent import Vehicle
+from constants import *
+
+# Settings swept by default.  Map sizes are given as multiples of the size of the window's map
+CAR_COUNTS = [61, 250, 1000]
+BLOCK_LENGTHS = [12, 24, 48]
+MAP_SCALES = [1, 2]
+METHODS = ["normal", "flocking"]
+ENGINES = ["objects", "events", "fleet", "mesoscopic"]
+
+
+class DistanceCounter:
+    def __init__(self):
+        """Stands in for a `TripLogger`, adding up how far the cars that finished their trips drove"""
+        self.distance = 0
+
+    def log_trip(self, record):
+        self.distance += record.distance
+
+    def log_trips(self, records):
+        for record in records:
+            self.distance += record.distance
+
+
+def make_engine(engine, num_cars, method_name, city_map, seed, trip_logger=None):
+    if engine == "fleet":
+        return Fleet(num_cars=num_cars, method=method_name, seed=seed, city_map=city_map, trip_logger=trip_logger)
+    if engine == "mesoscopic":
+        return LinkQueueSimulation(num_cars=num_cars, method=method_name, seed=seed, city_map=city_map,
+                                   trip_logger=trip_logger)
+    return Simulation(num_cars=num_cars, method=method_name, trip_logger=trip_logger, seed=seed, city_map=city_map,
+                      event_driven=engine == "events")
+
+
+def get_total_distance(simulation, distance_counter):
+    """Gets the number of moves made by every car so far, including the ones that have finished their trips"""
+    if isinstance(simulation, (Fleet, LinkQueueSimulation)):
+        on_the_road = int(simulation.distance_travelled.sum())
+    else:
+        on_the_road = sum(car.distance_travelled for car in simulation.cars)
+    return distance_counter.distance + on_the_road
+
+
+def time_spawn(simulation, num_spawns):
+    """Times how long it takes to give a car a random start and destination and plan its route.  Leaves the
+    simulation in a state it shouldn't be run from any more
+
+    :param simulation: `Simulation`, `Fleet` or `LinkQueueSimulation` object
+    :param num_spawns: Number of cars to spawn (only used by `Simulation`, which can't spawn more cars than there
+                       are free road tiles)
+    :return:           Seconds per car, or `None` if there's no room for any
+    """
+    if isinstance(simulation, Fleet):
+        # The fleet spawns cars in batches, so respawn all of them at once
+        cars = np.arange(simulation.num_cars)
+        simulation.clear_occupied_tiles(cars)
+        start_time = time.perf_counter()
+        simulation.spawn(cars)
+        return (time.perf_counter() - start_time) / simulation.num_cars
+    if isinstance(simulation, LinkQueueSimulation):
+        cars = np.arange(simulation.num_cars)
+        start_time = time.perf_counter()
+        simulation.spawn(cars)
+        return (time.perf_counter() - start_time) / simulation.num_cars
+
+    num_spawns = min(num_spawns, len(simulation.city_map.free_road_tiles))
+    if num_spawns == 0:
+        return None
+    start_time = time.perf_counter()
+    cars = [simulation.spawn_vehicle() for _ in range(num_spawns)]
+    elapsed = time.perf_counter() - start_time
+    for car in cars:
+        car.destroy()
+    return elapsed / num_spawns
+
+
+def benchmark_engine(engine, num_cars, method_name, block_length=BLOCKLENGTH, map_scale=1, ticks=200, seed=0):
+    """Measures how fast an engine runs with the given settings
+
+    :param engine:       Either "objects" for `Simulation`, "events" for an event-driven `Simulation`, "fleet" for
+                         `Fleet` or "mesoscopic" for `LinkQueueSimulation`
+    :param num_cars:     Number of cars on the map
+    :param method_name:  Navigation method of the cars
+    :param block_length: Distance between neighboring streets
+    :param map_scale:    Size of the map as a multiple of the window's map
+    :param ticks:        Number of ticks to time
+    :param seed:         Seed of the run
+    :return:             Dict of the settings and the measurements
+    """
+    width, height = CELLWIDTH * map_scale, CELLHEIGHT * map_scale
+
+    # Memory is measured on a separate copy of the simulation, since tracing allocations slows everything down
+    tracemalloc.start()
+    simulation = make_engine(engine, num_cars, method_name,
+                             make_map(RandomStreams(seed), width=width, height=height, block_length=block_length), seed)
+    memory_bytes, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del simulation
+
+    start_time = time.perf_counter()
+    city_map = make_map(RandomStreams(seed), width=width, height=height, block_length=block_length)
+    map_seconds = time.perf_counter() - start_time
+
+    distance_counter = DistanceCounter()
+    start_time = time.perf_counter()
+    simulation = make_engine(engine, num_cars, method_name, city_map, seed, trip_logger=distance_counter)
+    setup_seconds = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    simulation.run(ticks)
+    run_seconds = time.perf_counter() - start_time
+    moves = get_total_distance(simulation, distance_counter)
+
+    return {
+        'engine': engine,
+        'num_cars': num_cars,
+        'method': method_name,
+        'block_length': block_length,
+        'width': width,
+        'height': height,
+        'intersections': len(city_map.intersection_tiles),
+        'ticks': ticks,
+        'ticks_per_second': ticks / run_seconds,
+        'moves_per_second': moves / run_seconds,
+        'trips_completed': simulation.trips_completed,
+        'map_seconds': map_seconds,
+        'setup_seconds': setup_seconds,
+        'spawn_seconds_per_car': time_spawn(simulation, min(num_cars, 100)),
+        'memory_bytes': memory_bytes,
+    }
+
+
+def time_per_call(function, arguments, repeat=5):
+    """Times a function over a list of arguments and gets the best time per call out of `repeat` runs
+
+    :param function:  Function to time
+    :param arguments: List of tuples of arguments to call it with
+    :param repeat:    Number of times to run through the arguments
+    :return:          Seconds per call
+    """
+    def run():
+        for args in arguments:
+            function(*args)
+
+    return min(timeit.repeat(run, number=1, repeat=repeat)) / len(arguments)
+
+
+def run_micro_benchmarks(seed=0, num_calls=10000, warmup_ticks=100):
+    """Times the hot methods of the map, the cars and the lights one call at a time, on a map that's been running for
+    `warmup_ticks` ticks
+
+    :return: Dict of benchmark name -> seconds per call
+    """
+    simulation = Simulation(num_cars=NUM_CARS, method="flocking", seed=seed)
+    simulation.run(warmup_ticks)
+    city_map = simulation.city_map
+    rng = np.random.default_rng(seed)
+
+    positions = [(int(x), int(y)) for x, y in zip(rng.integers(city_map.width, size=num_calls),
+                                                  rng.integers(city_map.height, size=num_calls))]
+    intersections = [(city_map.intersection_tiles[i].position,)
+                     for i in rng.integers(len(city_map.intersection_tiles), size=num_calls)]
+    cars = [(simulation.cars[i],) for i in rng.integers(len(simulation.cars), size=num_calls)]
+    # Poll lights of our own rather than the map's, which its `LightController` changes without polling.  Polling those
+    # would change them behind the controller's back, and the controller is timed on them afterwards
+    streams = RandomStreams(seed)
+    lights = [(TrafficLight(light.position, rng=streams.get_light_random(light_id)),)
+              for light_id, light in enumerate(city_map.traffic_lights)]
+
+    def get_cold_path(car):
+        city_map.route_cache.clear()
+        car.get_path()
+
+    return {
+        'Map.get_tile_at_position': time_per_call(city_map.get_tile_at_position, [(p,) for p in positions]),
+        'Map.get_adjacent_intersections': time_per_call(city_map.get_adjacent_intersections, intersections),
+        'Vehicle.get_path (cached routes)': time_per_call(Vehicle.get_path, cars[:1000]),
+        'Vehicle.get_path (empty route cache)': time_per_call(get_cold_path, cars[:200], repeat=1),
+        'Vehicle.get_cars_between_me_and_next_intersection':
+            time_per_call(Vehicle.get_cars_between_me_and_next_intersection, cars),
+        'Map.count_cars_ahead': time_per_call(lambda car: city_map.count_cars_ahead(car.position, car.path[0].position),
+                                              cars),
+        'TrafficLight.change_lights_possibly': time_per_call(lambda light: light.change_lights_possibly(),
+                                                             lights * max(num_calls // len(lights), 1)),
+        'LightController.update (all lights)': time_per_call(city_map.light_controller.update, [()] * 1000),
+    }
+
+
+def get_version():
+    """Gets the git commit being benchmarked, if there is one"""
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measures the speed of the simulation and writes the results as JSON")
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES, help="Engines to benchmark")
+    parser.add_argument('--cars', nargs='+', type=int, default=CAR_COUNTS, help="Numbers of cars to sweep")
+    parser.add_argument('--block-lengths', nargs='+', type=int, default=BLOCK_LENGTHS,
+                        help="Distances between streets to sweep")
+    parser.add_argument('--map-scales', nargs='+', type=int, default=MAP_SCALES,
+                        help="Map sizes to sweep, as multiples of the window's map")
+    parser.add_argument('--methods', nargs='+', choices=METHODS, default=METHODS, help="Navigation methods to sweep")
+    parser.add_argument('--ticks', type=int, default=200, help="Number of ticks to time for each setting")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of every run")
+    parser.add_argument('--skip-micro', action='store_true', help="Don't run the micro-benchmarks")
+    parser.add_argument('--output', default="benchmarks.json", help="JSON file to write the results to")
+    args = parser.parse_args()
+
+    results = {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'created': time.time(),
+        'sweep': [],
+        'micro': None if args.skip_micro else run_micro_benchmarks(seed=args.seed),
+    }
+    for engine, num_cars, block_length, map_scale, method_name in itertools.product(
+            args.engines, args.cars, args.block_lengths, args.map_scales, args.methods):
+        result = benchmark_engine(engine, num_cars, method_name, block_length=block_length, map_scale=map_scale,
+                                  ticks=args.ticks, seed=args.seed)
+        results['sweep'].append(result)
+        print(f"{engine:>10} {num_cars:>6} cars, {result['width']}x{result['height']} map with blocks of "
+              f"{block_length}, {method_name:>8}: {result['ticks_per_second']:9.1f} ticks/s, "
+              f"{result['moves_per_second']:11.1f} moves/s")
+
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
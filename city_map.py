@@ -1,36 +1,171 @@
-import random
-from copy import deepcopy
+import hashlib
+from bisect import bisect_left, bisect_right
+
+import numpy as np
 
 from constants import *
+from graph import Graph
+from random_streams import RandomStreams
+from routing import RouteCache, RoutingTable, plan_a_star_route, get_route_length
 from utilities import *
 from traffic_light import *
 
 
 class Map:
-    def __init__(self, tiles):
+    def __init__(self, tiles, streams=None):
+        """Creates a `Map` object, holding the tiles of the city along with its traffic lights and the cars on it
+
+        :param tiles:   2D list of `Tile` objects, indexed `[y][x]`
+        :param streams: `RandomStreams` object for the lights and for picking where cars start and finish.  Unseeded
+                        streams are made if not given
+        """
         self.tiles = tiles
+        self.height = len(tiles)
+        self.width = len(tiles[0])
+        self.streams = streams if streams is not None else RandomStreams()
         self.traffic_lights = []
         self.intersection_tiles = self.get_intersection_tiles()
-    #     self.intersections_graph = self.create_intersections_graph()
-    #
-    # def create_intersections_graph(self):
-    #     graph = Graph([])
-    #     for intersection in self.intersection_tiles:
-    #         # graph.add_node(intersection)
-    #         for neighbor in self.get_adjacent_intersections(intersection.position):
-    #             # graph.add_node(neighbor)
-    #             # graph.add_edge(intersection, neighbor, distance(intersection.position, neighbor.position))
-    #             graph.add_edge(intersection, neighbor, cost=distance(intersection.position, neighbor.position),
-    #                            both_ends=True)
-    #
-    #             # # Since our graph is undirected, we need to add the edge going in the opposite direction
-    #             # graph.add_edge(neighbor, intersection, distance(intersection.position, neighbor.position))
-    #
-    #     return graph
+        self.light_controller = LightController(self.traffic_lights)
+
+        # Number of cars on each tile travelling in each direction, indexed `[DIRECTION_CODES[direction], y, x]`.  Cars
+        # travelling in different directions can share a tile, but cars travelling in the same direction can't (see
+        # `has_car_going`)
+        self.cars_going = np.zeros((len(DIRECTIONS), self.height, self.width), dtype=np.int32)
+        # Lists of the cars on each shared tile, by position, in order of arrival.  Tiles with one car or none on them
+        # aren't listed, since `self.occupancy` already says which car that is
+        self.cars_on_tile = {}
+        # Which car is on each tile (by id, -1 if none), indexed `[y, x]`.  On a shared tile, it's the last to arrive
+        self.occupancy = np.full((self.height, self.width), -1, dtype=np.int32)
+        self.vehicles = {}  # Maps the ids in `self.occupancy` to the cars
+        self.update_cars_ahead_counts()
+
+        # Sets of the cars that are asleep until the car on a tile changes, or until the light on it changes, by
+        # position (see `Vehicle.fall_asleep`).  Woken cars are collected in `self.woken_cars` for the simulation
+        self.cars_sleeping_on_tile = {}
+        self.cars_sleeping_on_light = {}
+        self.woken_cars = []
+
+        # Positions of the road tiles without a car on them, in no particular order, along with the index of each in the
+        # list, so that a free tile can be picked, taken or freed up in constant time
+        self.free_road_tiles = [tile.position for row in tiles for tile in row if tile.is_road]
+        self.free_road_tile_indices = {position: index for index, position in enumerate(self.free_road_tiles)}
+
+        # Lets us find out whether a position is an intersection (and get its tile) in constant time
+        self.intersections_by_position = {tile.position: tile for tile in
+                                          self.intersection_tiles}
+        # Intersections are numbered by their index in `self.intersection_tiles`
+        self.intersection_ids = {tile: intersection_id for intersection_id, tile in enumerate(self.intersection_tiles)}
+
+        # Sorted coordinates of the intersections along each row (keyed by y) and each column (keyed by x), so that we
+        # can binary search for the next intersection along a street
+        self.intersection_rows = {}
+        self.intersection_columns = {}
+        for tile in self.intersection_tiles:
+            self.intersection_rows.setdefault(tile.position[1], []).append(tile.position[0])
+            self.intersection_columns.setdefault(tile.position[0], []).append(tile.position[1])
+        for coordinates in list(self.intersection_rows.values()) + list(self.intersection_columns.values()):
+            coordinates.sort()
+
+        self.intersection_neighbors = self.create_intersection_neighbors()
+        self.intersections_graph = self.create_intersections_graph()
+
+        # Routes between intersections are shared by all the cars on this map.  If a routing table is loaded, cars look
+        # up their next intersection in it instead
+        self.route_cache = RouteCache()
+        self.routing_table = None
+
+    def create_intersections_graph(self):
+        """Creates a weighted graph of the road network, with intersection tiles as vertices and the blocks between
+        neighboring intersections as edges
+
+        :return: `Graph` object
+        """
+        graph = Graph([])
+        for intersection in self.intersection_tiles:
+            for neighbor in self.get_adjacent_intersections(intersection.position):
+                graph.add_edge(intersection, neighbor, cost=distance(intersection.position, neighbor.position),
+                               both_ends=False)
+
+        return graph
+
+    def create_intersection_neighbors(self):
+        """Finds the neighboring intersection in each direction of every intersection.  Two intersections are only
+        neighbors if they're next to each other in the same row or column and every tile between them is road
+
+        :return: Dict mapping each intersection's `(x, y)` to a dict of direction -> neighboring intersection tile (or
+                 `None` if there's no neighbor in that direction)
+        """
+        neighbors = {position: {UP: None, DOWN: None, LEFT: None, RIGHT: None} for position in
+                     self.intersections_by_position}
+
+        for y, xs in self.intersection_rows.items():
+            for x_a, x_b in zip(xs, xs[1:]):
+                if all(self.tiles[y][x].is_road for x in range(x_a + 1, x_b)):
+                    neighbors[(x_a, y)][RIGHT] = self.intersections_by_position[(x_b, y)]
+                    neighbors[(x_b, y)][LEFT] = self.intersections_by_position[(x_a, y)]
+
+        for x, ys in self.intersection_columns.items():
+            for y_a, y_b in zip(ys, ys[1:]):
+                if all(self.tiles[y][x].is_road for y in range(y_a + 1, y_b)):
+                    neighbors[(x, y_a)][DOWN] = self.intersections_by_position[(x, y_b)]
+                    neighbors[(x, y_b)][UP] = self.intersections_by_position[(x, y_a)]
+
+        return neighbors
+
+    def get_route(self, start, end):
+        """Gets the route between two intersections, from the route cache if possible
+
+        :param start: Intersection tile to start from
+        :param end:   Intersection tile to finish at
+        :return:      Tuple of the intersection tiles along the route, including `start` and `end`
+        """
+        return self.route_cache.get_route(start, end, lambda a, b: plan_a_star_route(self, a, b))
+
+    def get_route_length(self, start, end):
+        """Gets the length of the shortest route between two intersections
+
+        :param start: Intersection tile to start from
+        :param end:   Intersection tile to finish at
+        :return:      Distance driven along the route
+        """
+        if self.routing_table is not None:
+            return self.routing_table.get_route_length(self.intersection_ids[start], self.intersection_ids[end])
+        return get_route_length(self.get_route(start, end))
+
+    def get_next_hop(self, intersection, destination):
+        """Looks up the intersection to drive to next from `intersection` in order to reach `destination`.  Only
+        available once a routing table has been loaded
+
+        :param intersection: Intersection tile we're currently at
+        :param destination:  Intersection tile we're heading for
+        :return:             Next intersection tile along the route
+        """
+        next_hop_id = self.routing_table.get_next_hop(self.intersection_ids[intersection],
+                                                      self.intersection_ids[destination])
+        return self.intersection_tiles[next_hop_id]
+
+    def load_routing_table(self, filename):
+        """Switches routing over to a precomputed next-hop table, reusing the one saved in `filename` if it was built
+        for this map
+
+        :param filename: Where the table is stored between runs
+        """
+        self.routing_table = RoutingTable.load_or_build(self, filename)
+
+    def get_signature(self):
+        """Gets a hash of the layout of the roads, used to make sure saved routing tables belong to this map
+
+        :return: Hex digest of the layout
+        """
+        layout = hashlib.sha1(f"{len(self.tiles[0])}x{len(self.tiles)}".encode())
+        for row in self.tiles:
+            layout.update(bytes(tile.is_road for tile in row))
+        return layout.hexdigest()
 
     def update_traffic_lights(self):
-        for tile in self.intersection_tiles:
-            tile.light.change_lights_possibly()
+        for light in self.light_controller.update():
+            if light.position in self.cars_sleeping_on_light:
+                self.woken_cars.extend(self.cars_sleeping_on_light.pop(light.position))
 
     def get_intersection_tiles(self):
         """Gets all tiles located at intersections.  This is important for pathfinding and placing street lights
@@ -45,19 +180,155 @@ class Map:
             tile_right = self.get_tile_right(tile.position)
 
             if (tile_up.is_road or tile_down.is_road) and (tile_left.is_road or tile_right.is_road):
-                tile.light = TrafficLight(tile.position)
+                tile.light = TrafficLight(tile.position, rng=self.streams.get_light_random(len(self.traffic_lights)))
                 self.traffic_lights.append(tile.light)
                 intersection_tiles.append(tile)
 
         return intersection_tiles
 
-    def draw_lights(self):
-        for light in self.traffic_lights:
-            light.draw()
+    def add_car(self, car, position):
+        """Puts a car onto a tile, holding it in the direction the car is travelling in"""
+        x, y = position
+        self.cars_going[DIRECTION_CODES[car.direction], y, x] += 1
+        previous_id = self.occupancy[y, x]
+        if previous_id >= 0:
+            self.cars_on_tile.setdefault(position, [self.vehicles[previous_id]]).append(car)
+        self.occupancy[y, x] = car.id
+        if position in self.cars_sleeping_on_tile:
+            self.woken_cars.extend(self.cars_sleeping_on_tile.pop(position))
+
+        # Take the tile out of the free tiles by moving the last free tile into its place
+        index = self.free_road_tile_indices.pop(position, None)
+        if index is not None:
+            last_position = self.free_road_tiles.pop()
+            if last_position != position:
+                self.free_road_tiles[index] = last_position
+                self.free_road_tile_indices[last_position] = index
+
+    def remove_car(self, car, position, direction=None):
+        """Takes a car off a tile
+
+        :param car:       `Vehicle` object
+        :param position:  Position of the tile
+        :param direction: Direction the car was travelling in when it was put onto the tile, if it's turned since
+        """
+        if direction is None:
+            direction = car.direction
+        x, y = position
+        self.cars_going[DIRECTION_CODES[direction], y, x] -= 1
+        if position in self.cars_sleeping_on_tile:
+            self.woken_cars.extend(self.cars_sleeping_on_tile.pop(position))
+        cars = self.cars_on_tile.get(position)
+        if cars is not None:
+            # Another car is still on the tile, so it stays taken
+            cars.remove(car)
+            self.occupancy[y, x] = cars[-1].id
+            if len(cars) == 1:
+                del self.cars_on_tile[position]
+            return
+
+        self.occupancy[y, x] = -1
+        self.free_road_tile_indices[position] = len(self.free_road_tiles)
+        self.free_road_tiles.append(position)
+
+    def has_car_going(self, position, direction):
+        """Checks whether any of the cars on a tile is travelling in `direction`"""
+        return self.cars_going[DIRECTION_CODES[direction], position[1], position[0]] > 0
+
+    def get_free_road_tile_position(self, rng=None):
+        """Picks a road tile without a car on it, for a new car to start from
+
+        :param rng: `random.Random` generator to pick the tile with, the map's spawn stream by default
+        :return:    Position of the tile, or `None` if every road tile has a car on it
+        """
+        if not self.free_road_tiles:
+            return None
+        if rng is None:
+            rng = self.streams.spawn
+        return self.free_road_tiles[rng.randrange(len(self.free_road_tiles))]
+
+    def get_car_ids_between(self, position, target):
+        """Gets the ids of the cars between `position` (exclusive) and `target` (inclusive), which must be in the same
+        row or column, ordered from nearest to farthest
+
+        :param position: Starting position
+        :param target:   Finishing position
+        :return:         Array of car ids
+        """
+        x, y = position
+        target_x, target_y = target
+        if y == target_y:
+            if target_x >= x:
+                car_ids = self.occupancy[y, x + 1:target_x + 1]
+            else:
+                car_ids = self.occupancy[y, target_x:x][::-1]
+        elif x == target_x:
+            if target_y >= y:
+                car_ids = self.occupancy[y + 1:target_y + 1, x]
+            else:
+                car_ids = self.occupancy[target_y:y, x][::-1]
+        else:
+            raise ValueError(f"Positions must be in either the same column or the same row!")
+
+        return car_ids[car_ids >= 0]
+
+    def get_positions_between(self, position, target):
+        """Gets the positions between `position` (exclusive) and `target` (inclusive), which must be in the same row or
+        column, ordered from nearest to farthest
+        """
+        (x, y), (target_x, target_y) = position, target
+        if y == target_y:
+            step = 1 if target_x >= x else -1
+            return [(other_x, y) for other_x in range(x + step, target_x + step, step)]
+        elif x == target_x:
+            step = 1 if target_y >= y else -1
+            return [(x, other_y) for other_y in range(y + step, target_y + step, step)]
+        raise ValueError(f"Positions must be in either the same column or the same row!")
+
+    def count_cars_between(self, position, target):
+        return len(self.get_car_ids_between(position, target))
+
+    def update_cars_ahead_counts(self):
+        """Takes prefix sums of the cars along every row and column, which `count_cars_ahead` answers from until the
+        next call.  Simulations call this at the start of every tick, so that every car sees the cars ahead of it as
+        they were when the tick started, however many have moved since
+        """
+        self.row_car_sums, self.column_car_sums = get_occupancy_sums(self.occupancy >= 0)
+
+    def count_cars_ahead(self, position, target):
+        """Counts the cars between `position` (exclusive) and `target` (inclusive), which must be in the same row or
+        column, as of the last call to `update_cars_ahead_counts`.  Takes a couple of lookups however far apart they are
+        """
+        (x, y), (target_x, target_y) = position, target
+        if y == target_y:
+            if target_x >= x:
+                return int(self.row_car_sums[y, target_x + 1] - self.row_car_sums[y, x + 1])
+            return int(self.row_car_sums[y, x] - self.row_car_sums[y, target_x])
+        elif x == target_x:
+            if target_y >= y:
+                return int(self.column_car_sums[target_y + 1, x] - self.column_car_sums[y + 1, x])
+            return int(self.column_car_sums[y, x] - self.column_car_sums[target_y, x])
+        raise ValueError(f"Positions must be in either the same column or the same row!")
 
     def get_tile_at_position(self, position):
-        return [t for t in self.get_flat_list_of_tiles() if
-                t.position['x'] == position['x'] and t.position['y'] == position['y']][0]
+        """Gets the tile at the given position.  Tiles are stored as `self.tiles[y][x]`, so this is a constant time
+        lookup
+
+        :param position: Position of the tile
+        :return:         Tile at that position
+        """
+        return self.tiles[position[1]][position[0]]
+
+    def get_intersection_at_position(self, position):
+        """Gets the intersection tile at the given position
+
+        :param position: Position to check
+        :return:         Intersection tile at that position, or `None` if the position isn't an intersection
+        """
+        return self.intersections_by_position.get(position)
+
+    def is_intersection(self, position):
+        return position in self.intersections_by_position
 
     def get_current_tile(self, position):
         """Gets tile at the current position
@@ -65,7 +336,7 @@ class Map:
         :param position: Current position
         :return:         Tile the car is currently on top of
         """
-        return self.tiles[position['y']][position['x']]
+        return self.tiles[position[1]][position[0]]
 
     def get_tile_up(self, position):
         """Gets tile one tile up from current position
@@ -73,9 +344,9 @@ class Map:
         :param position: Current position
         :return:         If there's a tile up from current tile, return that, otherwise return `None`
         """
-        if position['y'] <= 0:
+        if position[1] <= 0:
             return None
-        return self.tiles[position['y'] - 1][position['x']]
+        return self.tiles[position[1] - 1][position[0]]
 
     def get_tile_down(self, position):
         """Gets tile one tile down from current position
@@ -83,9 +354,9 @@ class Map:
         :param position: Current position
         :return:         If there's a tile down from current tile, return that, otherwise return `None`
         """
-        if position['y'] >= CELLHEIGHT - 1:
+        if position[1] >= self.height - 1:
             return None
-        return self.tiles[position['y'] + 1][position['x']]
+        return self.tiles[position[1] + 1][position[0]]
 
     def get_tile_left(self, position):
         """Gets tile one tile left from current position
@@ -93,9 +364,9 @@ class Map:
         :param position: Current position
         :return:         If there's a tile left from current tile, return that, otherwise return `None`
         """
-        if position['x'] <= 0:
+        if position[0] <= 0:
             return None
-        return self.tiles[position['y']][position['x'] - 1]
+        return self.tiles[position[1]][position[0] - 1]
 
     def get_tile_right(self, position):
         """Gets tile one tile right from current position
@@ -103,22 +374,25 @@ class Map:
         :param position: Current position
         :return:         If there's a tile right from current tile, return that, otherwise return `None`
         """
-        if position['x'] >= CELLWIDTH - 1:
+        if position[0] >= self.width - 1:
             return None
-        return self.tiles[position['y']][position['x'] + 1]
+        return self.tiles[position[1]][position[0] + 1]
 
-    def get_random_road_tile_position(self):
+    def get_random_road_tile_position(self, rng=None):
         """Gets a tile where a car can reasonably start from
 
-        :return: Tile on which a car may start
+        :param rng: `random.Random` generator to pick the tile with, the map's spawn stream by default
+        :return:    Tile on which a car may start
         """
+        if rng is None:
+            rng = self.streams.spawn
         try:
-            random_row = list(filter(lambda x: x.is_road, random.choice(self.tiles)))
+            random_row = list(filter(lambda x: x.is_road, rng.choice(self.tiles)))
             while not random_row:
-                random_row = list(filter(lambda x: x.is_road, random.choice(self.tiles)))
-            starting_tile = random.choice(random_row)
+                random_row = list(filter(lambda x: x.is_road, rng.choice(self.tiles)))
+            starting_tile = rng.choice(random_row)
             # return {'x': starting_tile.position['x'], 'y': starting_tile.position['y']}
-            return deepcopy(starting_tile.position)
+            return starting_tile.position
         except IndexError:
             pass
 
@@ -131,110 +405,74 @@ class Map:
                 closest_intersection = tile
                 closest_intersection_dist = dist
 
-        return deepcopy(closest_intersection.position)
+        return closest_intersection.position
 
     def get_adjacent_intersections(self, position):
-        """Assumes `position` is the position of an intersection tile.  Gets all adjacent intersection tiles
+        """Gets all intersection tiles adjacent to `position`.  If `position` is an intersection, these are its
+        neighbors up, down, left and right.  Otherwise they're the two intersections at the ends of the block it's on
 
-        :param position: Current intersection tile's position
+        :param position: Current position
         :return:         All adjacent intersection tiles
         """
-        adjacent_tiles = []
-
         # If we're not at an intersection, just get the two intersections at end of the which block we're on
-        if (position['x'], position['y']) not in [(tile.position['x'], tile.position['y']) for tile in
-                                                  self.intersection_tiles]:
-            # adjacent_tiles.append(self.get_tile_at_position(self.get_nearest_intersections_positions(position)))
-            # adjacent_tiles.append(self.get_tile_at_position(
-            #     self.get_nearest_intersections_positions(position, excluded_intersections=[adjacent_tiles[0]])))
-
-            if position['x'] in [t.position['x'] for t in self.intersection_tiles]:
-                adjacent_tiles.append(self.get_intersection_up(position))
-                adjacent_tiles.append(self.get_intersection_down(position))
-            elif position['y'] in [t.position['y'] for t in self.intersection_tiles]:
-                adjacent_tiles.append(self.get_intersection_left(position))
-                adjacent_tiles.append(self.get_intersection_right(position))
-
-            return adjacent_tiles
-
-        # Check nearest four intersection tiles, because our intersections can only have a maximum of four neighbors
-        # (one up, one down, one left, and one right)
-        nearest_intersections = list(sorted(self.intersection_tiles, key=lambda x: distance(position, x.position)))
-        nearest_intersections.remove(self.get_tile_at_position(position))  # Don't include tile we're currently at
-        for tile in nearest_intersections[:4]:
-            if tile.position['x'] == position['x']:
-                if tile.position['x'] not in [t.position['x'] for t in adjacent_tiles]:
-                    adjacent_tiles.append(tile)
-                # If there's a tile in the same column (x increments across the columns, remember), then make sure it's
-                # on the other side of the tile whose neighbors we want to find.  This prevents, for example, the upper
-                # left corner tile from returning both the intersection immediately below it and the intersection below
-                # that as its neighbors
-                else:
-                    other_tile_y = [t.position['y'] for t in adjacent_tiles if t.position['x'] == tile.position['x']][0]
-
-                    # Make sure the central tile is between the existing neighbor and the potential one
-                    if tile.position['y'] < position['y'] < other_tile_y or other_tile_y < position['y'] < \
-                            tile.position['y']:
-                        adjacent_tiles.append(tile)
-            elif tile.position['y'] == position['y']:
-                if tile.position['y'] not in [t.position['y'] for t in adjacent_tiles]:
-                    adjacent_tiles.append(tile)
-                else:
-                    other_tile_x = [t.position['x'] for t in adjacent_tiles if t.position['y'] == tile.position['y']][0]
-
-                    if tile.position['x'] < position['x'] < other_tile_x or other_tile_x < position['x'] < \
-                            tile.position['x']:
-                        adjacent_tiles.append(tile)
-
-        return adjacent_tiles
+        if not self.is_intersection(position):
+            if position[0] in self.intersection_columns:
+                return [self.get_intersection_up(position), self.get_intersection_down(position)]
+            elif position[1] in self.intersection_rows:
+                return [self.get_intersection_left(position), self.get_intersection_right(position)]
+            return []
+
+        neighbors = self.intersection_neighbors[position]
+        return [neighbors[direction] for direction in (UP, DOWN, LEFT, RIGHT) if neighbors[direction] is not None]
 
     def get_intersection_up(self, position):
-        """Assumes position is in a road going up and down
+        """Assumes position is in a road going up and down.  Gets the nearest intersection at or above `position`
 
-        :param position:
-        :return:
+        :param position: Current position
+        :return:         Intersection tile
         """
-        for tile in [t for t in self.intersection_tiles if t.position['x'] == position['x']]:
-            if position['y'] - BLOCKLENGTH <= tile.position['y'] <= position['y']:
-                return tile
-
-        raise ValueError(f"Couldn't find intersection up")
+        ys = self.intersection_columns.get(position[0], [])
+        index = bisect_right(ys, position[1]) - 1
+        if index < 0:
+            raise ValueError(f"Couldn't find intersection up")
+        return self.intersections_by_position[(position[0], ys[index])]
 
     def get_intersection_down(self, position):
-        """Assumes position is in a road going up and down
+        """Assumes position is in a road going up and down.  Gets the nearest intersection at or below `position`
 
-        :param position:
-        :return:
+        :param position: Current position
+        :return:         Intersection tile
         """
-        for tile in [t for t in self.intersection_tiles if t.position['x'] == position['x']]:
-            if position['y'] <= tile.position['y'] <= position['y'] + BLOCKLENGTH:
-                return tile
-
-        raise ValueError(f"Couldn't find intersection up")
+        ys = self.intersection_columns.get(position[0], [])
+        index = bisect_left(ys, position[1])
+        if index >= len(ys):
+            raise ValueError(f"Couldn't find intersection down")
+        return self.intersections_by_position[(position[0], ys[index])]
 
     def get_intersection_left(self, position):
-        """Assumes position is in a road going left and right
+        """Assumes position is in a road going left and right.  Gets the nearest intersection at or left of `position`
 
-        :param position:
-        :return:
+        :param position: Current position
+        :return:         Intersection tile
         """
-        for tile in [t for t in self.intersection_tiles if t.position['y'] == position['y']]:
-            if position['x'] - BLOCKLENGTH <= tile.position['x'] <= position['x']:
-                return tile
-
-        raise ValueError(f"Couldn't find intersection up")
+        xs = self.intersection_rows.get(position[1], [])
+        index = bisect_right(xs, position[0]) - 1
+        if index < 0:
+            raise ValueError(f"Couldn't find intersection left")
+        return self.intersections_by_position[(xs[index], position[1])]
 
     def get_intersection_right(self, position):
-        """Assumes position is in a road going left and right
+        """Assumes position is in a road going left and right.  Gets the nearest intersection at or right of
+        `position`
 
-        :param position:
-        :return:
+        :param position: Current position
+        :return:         Intersection tile
         """
-        for tile in [t for t in self.intersection_tiles if t.position['y'] == position['y']]:
-            if position['x'] <= tile.position['x'] <= position['x'] + BLOCKLENGTH:
-                return tile
-
-        raise ValueError(f"Couldn't find intersection up")
+        xs = self.intersection_rows.get(position[1], [])
+        index = bisect_left(xs, position[0])
+        if index >= len(xs):
+            raise ValueError(f"Couldn't find intersection right")
+        return self.intersections_by_position[(xs[index], position[1])]
 
     def get_tiles_between_tile_a_and_tile_b(self, tile_a, tile_b):
         """Gets list of tiles between `tile_a` and `tile_b`.  These tiles must be in either the same column or row, and
@@ -246,41 +484,41 @@ class Map:
         :param tile_b: Finishing tile (inclusive)
         :return:       List of the tiles in the range
         """
-        if tile_a.position['x'] != tile_b.position['x'] and tile_a.position['y'] != tile_b.position['y']:
+        if tile_a.position[0] != tile_b.position[0] and tile_a.position[1] != tile_b.position[1]:
             raise ValueError(f"Tiles must be in either the same column or the same row!")
 
         tiles = []
 
         # We can use the intersections to check whether the tiles can be connected by a straight line of road tiles
-        if tile_a.position['x'] == tile_b.position['x']:
-            if tile_a.position['x'] not in [t.position['x'] for t in self.intersection_tiles]:
+        if tile_a.position[0] == tile_b.position[0]:
+            if tile_a.position[0] not in self.intersection_columns:
                 raise ValueError(f"Tiles must be connected by a road in the same column!")
-            if tile_a.position['y'] > tile_b.position['y']:
+            if tile_a.position[1] > tile_b.position[1]:
                 next_tile_method = self.get_tile_up
-            elif tile_a.position['y'] < tile_b.position['y']:
+            elif tile_a.position[1] < tile_b.position[1]:
                 next_tile_method = self.get_tile_down
             else:
                 raise ValueError(f"Tiles shouldn't be the same!")
 
-            tiles.append(self.get_tile_at_position(next_tile_method(tile_a.position).position))
+            tiles.append(next_tile_method(tile_a.position))
 
-            while tile_b not in tiles:
-                tiles.append(self.get_tile_at_position(next_tile_method(tiles[-1].position).position))
+            while tiles[-1] is not tile_b:
+                tiles.append(next_tile_method(tiles[-1].position))
 
-        if tile_a.position['y'] == tile_b.position['y']:
-            if tile_a.position['y'] not in [t.position['y'] for t in self.intersection_tiles]:
+        if tile_a.position[1] == tile_b.position[1]:
+            if tile_a.position[1] not in self.intersection_rows:
                 raise ValueError(f"Tiles must be connected by a road in the same row!")
-            if tile_a.position['x'] > tile_b.position['x']:
+            if tile_a.position[0] > tile_b.position[0]:
                 next_tile_method = self.get_tile_left
-            elif tile_a.position['x'] < tile_b.position['x']:
+            elif tile_a.position[0] < tile_b.position[0]:
                 next_tile_method = self.get_tile_right
             else:
                 raise ValueError(f"Tiles shouldn't be the same!")
 
-            tiles.append(self.get_tile_at_position(next_tile_method(tile_a.position).position))
+            tiles.append(next_tile_method(tile_a.position))
 
-            while tile_b not in tiles:
-                tiles.append(self.get_tile_at_position(next_tile_method(tiles[-1].position).position))
+            while tiles[-1] is not tile_b:
+                tiles.append(next_tile_method(tiles[-1].position))
 
         return tiles
 
@@ -293,68 +531,77 @@ class Map:
 
 
 class Tile:
+    __slots__ = ('position', 'is_road', 'light')
+
     def __init__(self, position, is_road):
         """Creates a `Tile` object, representing a square in the map of the city
 
         :param position: Position of the tile
         :param is_road:  Bool, whether or not this tile is a road tile (and hence drivable or not)
         """
-        self.position = deepcopy(position)
+        self.position = position  # `(x, y)` tuple, which cars share rather than copy
         self.is_road = is_road
-        self.car = None  # The car, if any, on the current tile
         self.light = None
 
-    def add_car(self, car):
-        # if self.car is not None:
-        #     car.explode()
-        self.car = car
 
-    def remove_car(self, car):
-        # if self.car != car:
-        #     # Note from car owner's manual: If your car explodes upon startup, this is not unexpected behavior.
-        #     # Please continue to enjoy your car!
-        #     car.explode()
-        self.car = None
+def get_occupancy_sums(occupied):
+    """Takes prefix sums of the occupied tiles along the rows and columns, so that the number of occupied tiles in any
+    stretch of a row or column is the difference of two of them
+
+    :param occupied: 2D boolean array of which tiles have a car on them, indexed `[y, x]`
+    :return:         `(row_sums, column_sums)`, where `row_sums[y, k]` is the number of occupied tiles in row `y` left of
+                     column `k`, and `column_sums[k, x]` is the number in column `x` above row `k`
+    """
+    height, width = occupied.shape
+    row_sums = np.zeros((height, width + 1), dtype=np.int32)
+    np.cumsum(occupied, axis=1, out=row_sums[:, 1:])
+    column_sums = np.zeros((height + 1, width), dtype=np.int32)
+    np.cumsum(occupied, axis=0, out=column_sums[1:, :])
+    return row_sums, column_sums
 
 
-def make_map():
+def make_map(streams=None, width=CELLWIDTH, height=CELLHEIGHT, block_length=BLOCKLENGTH):
     """Makes a city map
 
-    :return: `Map` object, consisting of a bunch of tiles
+    :param streams:      `RandomStreams` object for the map's randomness, unseeded if not given
+    :param width:        Number of tiles across the map
+    :param height:       Number of tiles down the map
+    :param block_length: Distance between neighboring streets
+    :return:             `Map` object, consisting of a bunch of tiles
     """
     tiles = []
     max_x = 0
     max_y = 0
-    for row_idx, y in enumerate(range(0, CELLHEIGHT)):
+    for row_idx, y in enumerate(range(0, height)):
         # Add a list for the new row
         tiles.append([])
         if row_idx > max_y:
             max_y = row_idx
 
-        for col_idx, x in enumerate(range(0, CELLWIDTH)):
+        for col_idx, x in enumerate(range(0, width)):
             if col_idx > max_x:
                 max_x = col_idx
 
             # Make buffer around map so that cars don't attempt to drive off the edge
-            if y == 0 or x == 0 or y == CELLHEIGHT - 1 or x == CELLWIDTH - 1:
-                tiles[row_idx].append(Tile(position={'x': x, 'y': y}, is_road=False))
+            if y == 0 or x == 0 or y == height - 1 or x == width - 1:
+                tiles[row_idx].append(Tile(position=(x, y), is_road=False))
                 continue
 
             # Make roads all along the edge of the map (actually, one tile in from the edge)
-            elif y == 1 or x == 1 or y == CELLHEIGHT - 2 or x == CELLWIDTH - 2:
-                tiles[row_idx].append(Tile(position={'x': x, 'y': y}, is_road=True))
+            elif y == 1 or x == 1 or y == height - 2 or x == width - 2:
+                tiles[row_idx].append(Tile(position=(x, y), is_road=True))
                 continue
 
-            elif y % BLOCKLENGTH == 0 or x % BLOCKLENGTH == 0:
-                tiles[row_idx].append(Tile(position={'x': x, 'y': y}, is_road=True))
+            elif y % block_length == 0 or x % block_length == 0:
+                tiles[row_idx].append(Tile(position=(x, y), is_road=True))
                 continue
 
             # We'll handle the `drop` and `obstacle` stuff later, because we don't want to have too many drops or
             # obstacles that the cars can't move
             else:
-                tile = Tile(position={'x': x, 'y': y}, is_road=False)
+                tile = Tile(position=(x, y), is_road=False)
                 tiles[row_idx].append(tile)
 
-    city_map = Map(tiles)
+    city_map = Map(tiles, streams=streams)
 
     return city_map
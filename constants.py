@@ -1,6 +1,3 @@
-import pygame
-
-
 FPS = 48
 WINDOWWIDTH = 640 + 320 + 192
 WINDOWHEIGHT = 480 + 240 + 144
@@ -9,9 +6,9 @@ assert WINDOWWIDTH % CELLSIZE == 0, "Window width must be a multiple of cell siz
 assert WINDOWHEIGHT % CELLSIZE == 0, "Window height must be a multiple of cell size."
 CELLWIDTH = int(WINDOWWIDTH / CELLSIZE)
 CELLHEIGHT = int(WINDOWHEIGHT / CELLSIZE)
-NUM_CARS = 61
-assert NUM_CARS < 130  # Simulation doesn't seem to want to run at all if there are too many cars
+NUM_CARS = 61  # Cars that don't fit on the free road tiles wait in the simulation's spawn backlog
 BLOCKLENGTH = 24
+ROUTE_CACHE_SIZE = 4096  # Number of routes between pairs of intersections that the map remembers
 # MAX_DIST_WITHOUT_TURNING = int(min(CELLWIDTH, CELLHEIGHT) / 3)
 
 #                   R    G    B
@@ -39,13 +36,19 @@ UP = 'up'
 DOWN = 'down'
 LEFT = 'left'
 RIGHT = 'right'
-
-# Initialize some constants
-pygame.init()
-
-FPSCLOCK = pygame.time.Clock()
-DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
-BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
+# Order of the directions when they're stored as small integers, e.g. in NumPy arrays
+DIRECTIONS = [UP, DOWN, LEFT, RIGHT]
+DIRECTION_CODES = {direction: code for code, direction in enumerate(DIRECTIONS)}
+DIRECTION_OFFSETS = {UP: (0, -1), DOWN: (0, 1), LEFT: (-1, 0), RIGHT: (1, 0)}
 
 logfile_name = "waiting_times.csv"
+TRIP_STORE_EXTENSION = ".trips"  # Trip logs with this extension are written in the columnar format of trip_store.py
+TRIP_LOG_BATCH_SIZE = 1024  # Number of completed trips to collect before writing them to the log
+TRIP_LOG_FLUSH_INTERVAL = 5.0  # Maximum number of seconds a completed trip waits before being written to the log
+SLEEP_AFTER_TICKS_BLOCKED = 3  # Number of ticks a car has to be stuck for before an event-driven simulation skips it
+LINK_STUCK_TICKS = 10  # Ticks a car in the link-queue engine waits behind a full link before squeezing onto it
+INSTRUMENT = False  # Whether vehicle_sim.py times each phase of every tick and writes a summary to INSTRUMENTATION_FILE
+INSTRUMENTATION_FILE = "instrumentation.json"
+INSTRUMENTATION_WINDOW = 1000  # Number of most recent ticks that the instrumentation summary covers
+INSTRUMENTATION_ALLOCATION_INTERVAL = 100  # Number of ticks between samples of the allocations, when tracing them
 method = "flocking"
\ No newline at end of file
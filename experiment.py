@@ -0,0 +1,176 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from city_map import make_map
+from fleet import Fleet
+from mesoscopic import LinkQueueSimulation
+from random_streams import RandomStreams
+from simulation import Simulation
+from constants import *
+
+# One headless run of the simulation.  A replica stops after `ticks` ticks or once `trips` trips have been completed,
+# whichever is given (or comes first, if both are)
+Replica = namedtuple('Replica', 'method, replica, seed, ticks, trips, num_cars, engine, routing_table_file')
+
+# Statistics gathered from every trip of a replica
+TRIP_STATISTICS = ['frames_waited_at_red_lights', 'trip_ticks', 'distance']
+
+
+class TripCollector:
+    def __init__(self):
+        """Stands in for a `TripLogger` inside a replica, keeping the completed trips in memory instead of writing them
+        out, so that the replica can summarize them once it's done
+        """
+        self.records = []
+
+    def log_trip(self, record):
+        self.records.append(record)
+
+    def log_trips(self, records):
+        self.records.extend(records)
+
+    def close(self):
+        pass
+
+
+def run_replica(replica):
+    """Runs a single replica from start to finish.  This is what the workers of the process pool run
+
+    :param replica: `Replica` to run
+    :return:        Dict of the replica's settings and summary statistics
+    """
+    start_time = time.perf_counter()
+    streams = RandomStreams(replica.seed).get_split(replica.replica)
+    trip_collector = TripCollector()
+    if replica.engine in ("fleet", "mesoscopic"):
+        city_map = make_map(streams)
+        if replica.routing_table_file is not None:
+            city_map.load_routing_table(replica.routing_table_file)
+        engine = Fleet if replica.engine == "fleet" else LinkQueueSimulation
+        simulation = engine(num_cars=replica.num_cars, method=replica.method, seed=streams, city_map=city_map,
+                            trip_logger=trip_collector)
+    else:
+        simulation = Simulation(num_cars=replica.num_cars, method=replica.method,
+                                routing_table_file=replica.routing_table_file, trip_logger=trip_collector,
+                                seed=streams, event_driven=replica.engine == "events")
+
+    while not ((replica.ticks is not None and simulation.tick_count >= replica.ticks) or
+               (replica.trips is not None and simulation.trips_completed >= replica.trips)):
+        simulation.step()
+
+    result = dict(replica._asdict(), ticks_run=simulation.tick_count, trips_completed=simulation.trips_completed,
+                  seconds=time.perf_counter() - start_time)
+    for statistic in TRIP_STATISTICS:
+        values = np.array([getattr(record, statistic) for record in trip_collector.records], dtype=np.float64)
+        result['mean_' + statistic] = float(values.mean()) if len(values) else None
+        result['std_' + statistic] = float(values.std()) if len(values) else None
+    return result
+
+
+def summarize(results):
+    """Combines the replicas of each method into a mean over the replicas with a 95% confidence interval
+
+    :param results: List of dicts returned by `run_replica`
+    :return:        Dict of method -> dict of statistic -> dict of 'mean', 'ci95' and 'replicas'
+    """
+    summary = {}
+    for method_name in sorted({result['method'] for result in results}):
+        summary[method_name] = {}
+        for statistic in ['trips_completed'] + ['mean_' + statistic for statistic in TRIP_STATISTICS]:
+            values = np.array([result[statistic] for result in results
+                               if result['method'] == method_name and result[statistic] is not None], dtype=np.float64)
+            if len(values) == 0:
+                continue
+            standard_error = values.std(ddof=1) / len(values) ** 0.5 if len(values) > 1 else float('nan')
+            summary[method_name][statistic] = {'mean': float(values.mean()), 'ci95': float(1.96 * standard_error),
+                                               'replicas': len(values)}
+    return summary
+
+
+def run_experiment(methods, num_replicas, ticks=None, trips=None, num_cars=NUM_CARS, engine="objects",
+                   routing_table_file=None, base_seed=0, processes=None):
+    """Runs `num_replicas` replicas of every method across a pool of processes.  Replica `i` of every method uses split
+    `i` of the random streams of `base_seed`, so the methods are compared on the same sequence of streams, and any
+    replica can be rerun on its own
+
+    :param methods:            List of navigation methods to compare
+    :param num_replicas:       Number of replicas of each method
+    :param ticks:              Number of ticks to run each replica for
+    :param trips:              Number of trips after which each replica stops
+    :param num_cars:           Number of cars on the map
+    :param engine:             Either "objects" for `Simulation`, "events" for an event-driven `Simulation`, "fleet"
+                               for `Fleet` or "mesoscopic" for `LinkQueueSimulation`
+    :param routing_table_file: If given, cars follow the routing table saved in (or built into) this file
+    :param base_seed:          Seed that the streams of every replica are split from
+    :param processes:          Number of worker processes, every core by default
+    :return:                   List of the dicts returned by `run_replica`, ordered by method and replica
+    """
+    if ticks is None and trips is None:
+        raise ValueError("Replicas need a number of ticks or trips to stop after")
+    if routing_table_file is not None:
+        # Build the table once up front, so that the workers only ever read the file
+        make_map().load_routing_table(routing_table_file)
+
+    replicas = [Replica(method=method_name, replica=i, seed=base_seed, ticks=ticks, trips=trips,
+                        num_cars=num_cars, engine=engine, routing_table_file=routing_table_file)
+                for method_name in methods for i in range(num_replicas)]
+    with multiprocessing.Pool(processes) as pool:
+        results = list(pool.imap_unordered(run_replica, replicas))
+    return sorted(results, key=lambda result: (methods.index(result['method']), result['replica']))
+
+
+def write_results(results, filename):
+    """Writes the results of an experiment to a single file: a CSV with one row per replica if `filename` ends in
+    .csv, and otherwise JSON holding every replica as well as the summary of each method
+
+    :param results:  List of dicts returned by `run_replica`
+    :param filename: File to write
+    """
+    if filename.endswith('.csv'):
+        with open(filename, 'w', newline='') as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=list(results[0]))
+            writer.writeheader()
+            writer.writerows(results)
+    else:
+        with open(filename, 'w') as outfile:
+            json.dump({'summary': summarize(results), 'replicas': results}, outfile, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares navigation methods over many headless replicas run in "
+                                                 "parallel")
+    parser.add_argument('--replicas', type=int, default=100, help="Number of replicas of each method")
+    parser.add_argument('--methods', nargs='+', choices=["normal", "flocking"], default=["normal", "flocking"],
+                        help="Navigation methods to compare")
+    parser.add_argument('--ticks', type=int, help="Number of ticks to run each replica for")
+    parser.add_argument('--trips', type=int, help="Number of trips after which each replica stops")
+    parser.add_argument('--cars', type=int, default=NUM_CARS, help="Number of cars on the map")
+    parser.add_argument('--engine', choices=["objects", "events", "fleet", "mesoscopic"], default="objects",
+                        help="Simulation engine to use")
+    parser.add_argument('--routing-table', help="File to save or reuse the map's routing table from")
+    parser.add_argument('--seed', type=int, default=0, help="Seed that the replicas' seeds are split from")
+    parser.add_argument('--processes', type=int, help="Number of worker processes, every core by default")
+    parser.add_argument('--output', default="experiment.json", help="File to write the results to (JSON or CSV)")
+    args = parser.parse_args()
+    if args.ticks is None and args.trips is None:
+        parser.error("one of --ticks or --trips is required")
+
+    results = run_experiment(args.methods, args.replicas, ticks=args.ticks, trips=args.trips, num_cars=args.cars,
+                             engine=args.engine, routing_table_file=args.routing_table, base_seed=args.seed,
+                             processes=args.processes)
+    write_results(results, args.output)
+    for method_name, statistics in summarize(results).items():
+        waited = statistics.get('mean_frames_waited_at_red_lights')
+        if waited is not None:
+            print(f"{method_name}: {waited['mean']:.3f} ± {waited['ci95']:.3f} frames waited at red lights per trip "
+                  f"over {waited['replicas']} replicas")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,370 @@
+import numpy as np
+
+from city_map import get_occupancy_sums, make_map
+from instrumentation import NO_INSTRUMENTATION
+from random_streams import RandomStreams, SPAWN_STREAM, DESTINATION_STREAM
+from constants import *
+from routing import RoutingTable
+from traffic_light import TrafficLightBank
+from trip_log import TripRecord
+
+UP_CODE, DOWN_CODE, LEFT_CODE, RIGHT_CODE = (DIRECTIONS.index(direction) for direction in (UP, DOWN, LEFT, RIGHT))
+DIRECTION_DX = np.array([DIRECTION_OFFSETS[direction][0] for direction in DIRECTIONS], dtype=np.int32)
+DIRECTION_DY = np.array([DIRECTION_OFFSETS[direction][1] for direction in DIRECTIONS], dtype=np.int32)
+
+
+class Fleet:
+    def __init__(self, num_cars=NUM_CARS, method=method, seed=None, city_map=None, trip_logger=None,
+                 instrumentation=NO_INSTRUMENTATION):
+        """Alternative to `Simulation` which stores every car as a row in a set of NumPy arrays and moves the whole
+        fleet at once with vectorized operations, rather than calling `Vehicle.move` on one object at a time.  Cars
+        follow the same rules as `Vehicle.move` and `Vehicle.can_move_to_tile`:
+
+        - cars head for their next waypoint along its row or column, one tile per sub-step
+        - a car can't enter an intersection whose light is red for the direction it's travelling in, and counts every
+          sub-step spent waiting there (the light is only told about the car when it first arrives)
+        - a car can't enter a tile held by a car travelling in the same direction, but can share one with cars going
+          in other directions
+        - in flocking mode, a car with other cars between it and its next waypoint gets a second sub-step
+
+        Cars that want the same spot on the same sub-step are resolved deterministically: the lowest index wins.  Cars
+        follow the map's routing table, so each only needs to keep its next waypoint.  Like in `Simulation`, cars are
+        only spawned onto road tiles without a car on them, and the cars there's no room for wait to be spawned
+
+        :param num_cars:        Number of cars to keep on the map at any time
+        :param method:          Navigation method of the cars, either "normal" or "flocking"
+        :param seed:            Seed for placing the cars and picking their destinations (see `RandomStreams`)
+        :param city_map:        `Map` object to drive on.  A new one, whose lights use the same seed, is made if not
+                                given
+        :param trip_logger:     `TripLogger` to record completed trips with, if any
+        :param instrumentation: `Instrumentation` object to time the phases of each tick with
+        """
+        self.method = method
+        self.trip_logger = trip_logger
+        self.instrumentation = instrumentation
+        self.num_cars = num_cars
+        self.streams = RandomStreams(seed)
+        self.city_map = city_map if city_map is not None else make_map(self.streams)
+        if self.city_map.routing_table is None:
+            self.city_map.routing_table = RoutingTable.build(self.city_map)
+        self.spawn_rng = self.streams.get_generator(SPAWN_STREAM)
+        self.destination_rng = self.streams.get_generator(DESTINATION_STREAM)
+        self.tick_count = 0
+        self.trips_completed = 0
+        self.frames_waited_at_red_lights = 0  # Total over all completed trips
+
+        self.load_map(self.city_map)
+        # The fleet changes its own copy of the map's lights, carrying on from the state they're in
+        self.lights = TrafficLightBank.from_lights(self.city_map.traffic_lights)
+
+        # State of each car
+        self.x = np.zeros(num_cars, dtype=np.int32)
+        self.y = np.zeros(num_cars, dtype=np.int32)
+        self.direction = np.full(num_cars, RIGHT_CODE, dtype=np.int8)
+        self.moved = np.ones(num_cars, dtype=bool)  # Whether the car moved on its last sub-step
+        self.waypoint_x = np.zeros(num_cars, dtype=np.int32)
+        self.waypoint_y = np.zeros(num_cars, dtype=np.int32)
+        self.waypoint_id = np.zeros(num_cars, dtype=np.int32)  # Intersection id of the waypoint, -1 for the destination
+        self.exit_id = np.zeros(num_cars, dtype=np.int32)  # Intersection at which the car leaves the network, or -1
+        self.destination_x = np.zeros(num_cars, dtype=np.int32)
+        self.destination_y = np.zeros(num_cars, dtype=np.int32)
+        self.velocity = np.ones(num_cars, dtype=np.int8)
+        self.frames_waited = np.zeros(num_cars, dtype=np.int32)
+        self.spawn_tick = np.zeros(num_cars, dtype=np.int64)
+        self.distance_travelled = np.zeros(num_cars, dtype=np.int32)
+        self.waiting_to_spawn = np.zeros(num_cars, dtype=bool)  # Cars that are due to be spawned once there's room
+
+        # `self.cars_holding[d, y, x]` is the number of cars holding tile (x, y) while travelling in direction `d`.  A
+        # car turning onto a tile can end up sharing it with a car already going its new way, just like on the map, so
+        # this is a count rather than a single car.  Cars take their starting tile as soon as they're spawned
+        self.cars_holding = np.zeros((len(DIRECTIONS), self.height, self.width), dtype=np.int32)
+
+        self.spawn(np.arange(num_cars))
+
+    def load_map(self, city_map):
+        """Flattens the parts of the map that the vectorized step needs into arrays"""
+        self.height = city_map.height
+        self.width = city_map.width
+        self.is_road = np.array([[tile.is_road for tile in row] for row in city_map.tiles], dtype=bool)
+
+        self.intersection_x = np.array([tile.position[0] for tile in city_map.intersection_tiles], dtype=np.int32)
+        self.intersection_y = np.array([tile.position[1] for tile in city_map.intersection_tiles], dtype=np.int32)
+        self.next_hops = city_map.routing_table.next_hops.astype(np.int32)
+        self.route_lengths = city_map.routing_table.route_lengths
+
+        # Index of the traffic light in `city_map.traffic_lights` (and so in `self.lights`) at each tile, or -1
+        self.light_id = np.full((self.height, self.width), -1, dtype=np.int32)
+        for light_id, light in enumerate(city_map.traffic_lights):
+            self.light_id[light.position[1], light.position[0]] = light_id
+
+        self.road_x, self.road_y, self.block_end_a, self.block_end_b = get_road_tiles(city_map)
+
+    def spawn(self, cars):
+        """Gives the cars at the indices `cars` a new random start on a free road tile and a random destination, and
+        picks the ends of their blocks at which they join and leave the intersection network so that the overall route
+        is as short as possible.  If there aren't enough free road tiles, the cars with the lowest indices (counting the
+        cars that were already waiting) are spawned and the rest wait in `self.waiting_to_spawn`
+
+        :param cars: Array of car indices
+        """
+        self.waiting_to_spawn[cars] = True
+        waiting = np.flatnonzero(self.waiting_to_spawn)
+        if len(waiting) == 0:
+            return
+        free = np.flatnonzero(~self.cars_holding[:, self.road_y, self.road_x].any(axis=0))
+        cars = waiting[:len(free)]
+        num_new = len(cars)
+        if num_new == 0:
+            return
+        starts = free[self.spawn_rng.choice(len(free), size=num_new, replace=False)]
+        destinations = self.destination_rng.integers(len(self.road_x), size=num_new)
+
+        start_x, start_y = self.road_x[starts], self.road_y[starts]
+        destination_x, destination_y = self.road_x[destinations], self.road_y[destinations]
+        entry, exit_, same_block = choose_entries_and_exits(self, starts, destinations)
+
+        self.x[cars], self.y[cars] = start_x, start_y
+        self.destination_x[cars], self.destination_y[cars] = destination_x, destination_y
+        self.waypoint_id[cars] = np.where(same_block, -1, entry)
+        self.exit_id[cars] = np.where(same_block, -1, exit_)
+        self.waypoint_x[cars] = np.where(same_block, destination_x, self.intersection_x[entry])
+        self.waypoint_y[cars] = np.where(same_block, destination_y, self.intersection_y[entry])
+
+        # Face the way the car sets off in, since that's the direction it holds its starting tile in until it moves.
+        # Cars starting on their entry intersection set off towards the one after it, or their destination
+        after_entry = self.next_hops[entry, exit_]
+        target_x = np.where(entry == exit_, destination_x, self.intersection_x[after_entry])
+        target_y = np.where(entry == exit_, destination_y, self.intersection_y[after_entry])
+        at_entry = ~same_block & (self.waypoint_x[cars] == start_x) & (self.waypoint_y[cars] == start_y)
+        dx = np.where(at_entry, target_x, self.waypoint_x[cars]) - start_x
+        dy = np.where(at_entry, target_y, self.waypoint_y[cars]) - start_y
+        self.direction[cars] = np.select([dy < 0, dy > 0, dx < 0], [UP_CODE, DOWN_CODE, LEFT_CODE], RIGHT_CODE)
+        np.add.at(self.cars_holding, (self.direction[cars], start_y, start_x), 1)
+        self.waiting_to_spawn[cars] = False
+        self.moved[cars] = True
+        self.velocity[cars] = 1
+        self.frames_waited[cars] = 0
+        self.spawn_tick[cars] = self.tick_count
+        self.distance_travelled[cars] = 0
+
+    def get_velocities(self):
+        if self.method != "flocking":
+            return np.ones(self.num_cars, dtype=np.int8)
+        cars_ahead = count_cars_ahead(self.cars_holding.any(axis=0), self.x, self.y, self.waypoint_x,
+                                      self.waypoint_y)
+        return np.where(cars_ahead > 0, 2, 1).astype(np.int8)
+
+    def step(self):
+        """Advances every car by a single tick and then updates the traffic lights"""
+        phase = self.instrumentation.phase
+        arrived = np.zeros(self.num_cars, dtype=bool)
+        with phase('moves'):
+            # Cars that are already at their destination or waypoint deal with that before working out their velocity
+            arrived |= self.advance_waypoints(~self.waiting_to_spawn)
+            self.velocity = self.get_velocities()
+
+            for sub_step in range(int(self.velocity.max())):
+                active = (self.velocity > sub_step) & ~arrived & ~self.waiting_to_spawn
+                arrived |= self.advance_waypoints(active)
+                arrived |= self.move(active & ~arrived)
+
+        with phase('spawning'):
+            self.finish_trips(np.flatnonzero(arrived))
+        with phase('lights'):
+            self.lights.update()
+        self.tick_count += 1
+
+    def run(self, num_ticks):
+        for _ in range(num_ticks):
+            self.step()
+            self.instrumentation.end_tick()
+
+    def advance_waypoints(self, active):
+        """Drops the waypoints that active cars have reached and looks up the next ones
+
+        :param active: Mask of the cars to check
+        :return:       Mask of the cars which are at their destination
+        """
+        at_destination = active & (self.x == self.destination_x) & (self.y == self.destination_y)
+        at_waypoint = active & ~at_destination & (self.x == self.waypoint_x) & (self.y == self.waypoint_y)
+
+        leaving = at_waypoint & (self.waypoint_id == self.exit_id)
+        self.waypoint_id[leaving] = -1
+        self.waypoint_x[leaving] = self.destination_x[leaving]
+        self.waypoint_y[leaving] = self.destination_y[leaving]
+
+        continuing = np.flatnonzero(at_waypoint & ~leaving)
+        next_hops = self.next_hops[self.waypoint_id[continuing], self.exit_id[continuing]]
+        self.waypoint_id[continuing] = next_hops
+        self.waypoint_x[continuing] = self.intersection_x[next_hops]
+        self.waypoint_y[continuing] = self.intersection_y[next_hops]
+
+        return at_destination
+
+    def move(self, active):
+        """Moves every active car one tile towards its waypoint, if it can
+
+        :param active: Mask of the cars taking this sub-step
+        :return:       Mask of the cars which reached their destination
+        """
+        # Head along the row or column of the next waypoint, or keep going the same way if we're on neither
+        new_direction = self.direction.copy()
+        same_column = self.waypoint_x == self.x
+        same_row = ~same_column & (self.waypoint_y == self.y)
+        new_direction[same_column & (self.waypoint_y < self.y)] = UP_CODE
+        new_direction[same_column & (self.waypoint_y > self.y)] = DOWN_CODE
+        new_direction[same_row & (self.waypoint_x < self.x)] = LEFT_CODE
+        new_direction[same_row & (self.waypoint_x > self.x)] = RIGHT_CODE
+
+        target_x = np.clip(self.x + DIRECTION_DX[new_direction], 0, self.width - 1)
+        target_y = np.clip(self.y + DIRECTION_DY[new_direction], 0, self.height - 1)
+
+        # Lights are checked against the direction the car has been travelling in, just like in `Vehicle`
+        light_ids = self.light_id[target_y, target_x]
+        at_red_light = active & (light_ids >= 0) & self.lights.is_red(np.maximum(light_ids, 0), self.direction)
+        self.frames_waited[at_red_light] += 1
+        # Only add one to the "waiting list" if the car just arrived; don't count subsequent iterations
+        arriving = at_red_light & self.moved
+        self.lights.add_cars_waiting_on_lights(light_ids[arriving], self.direction[arriving])
+
+        # Start by assuming everyone who could move will, then keep stopping the cars which are blocked by a car that
+        # isn't moving or that lost a tie for the same spot, until nothing changes
+        moving = active & ~at_red_light & self.is_road[target_y, target_x]
+        while True:
+            still_moving = moving & ~self.is_blocked(self.direction, target_x, target_y, moving)
+
+            candidates = np.flatnonzero(still_moving)
+            spots = self.get_tile_keys(new_direction[candidates], target_x[candidates], target_y[candidates])
+            _, winners = np.unique(spots, return_index=True)
+            still_moving[:] = False
+            still_moving[candidates[winners]] = True
+
+            if np.array_equal(still_moving, moving):
+                break
+            moving = still_moving
+
+        movers = np.flatnonzero(moving)
+        self.clear_occupied_tiles(movers)
+        self.x[movers] = target_x[movers]
+        self.y[movers] = target_y[movers]
+        self.direction[movers] = new_direction[movers]
+        self.distance_travelled[movers] += 1
+        np.add.at(self.cars_holding, (self.direction[movers], self.y[movers], self.x[movers]), 1)
+        self.moved[active] = moving[active]
+
+        return moving & (self.x == self.destination_x) & (self.y == self.destination_y)
+
+    def is_blocked(self, direction, target_x, target_y, moving):
+        """Checks whether each car's target tile is held, in `direction`, by a car that isn't moving away"""
+        # The tile is free to enter if every car holding it in that direction is moving away
+        movers = np.flatnonzero(moving)
+        num_leaving = np.bincount(self.get_tile_keys(self.direction[movers], self.x[movers], self.y[movers]),
+                                  minlength=self.cars_holding.size)
+        targets = self.get_tile_keys(direction, target_x, target_y)
+        return self.cars_holding.ravel()[targets] > num_leaving[targets]
+
+    def get_tile_keys(self, direction, x, y):
+        """Numbers each (direction, tile) pair, in the same order as the entries of `self.cars_holding`"""
+        return (direction.astype(np.int64) * self.height + y) * self.width + x
+
+    def clear_occupied_tiles(self, cars):
+        """Takes the cars off the tiles they were holding (cars waiting to be spawned aren't holding one)"""
+        cars = cars[~self.waiting_to_spawn[cars]]
+        np.subtract.at(self.cars_holding, (self.direction[cars], self.y[cars], self.x[cars]), 1)
+
+    def finish_trips(self, cars):
+        """Takes the cars that reached their destinations off the map and replaces them with new ones"""
+        self.clear_occupied_tiles(cars)
+        self.trips_completed += len(cars)
+        self.frames_waited_at_red_lights += int(self.frames_waited[cars].sum())
+        if self.trip_logger is not None:
+            self.trip_logger.log_trips(
+                TripRecord(frames_waited_at_red_lights=int(self.frames_waited[car]), method=self.method,
+                           trip_ticks=int(self.tick_count - self.spawn_tick[car]),
+                           distance=int(self.distance_travelled[car]), spawn_tick=int(self.spawn_tick[car]),
+                           arrival_tick=self.tick_count) for car in cars)
+        self.spawn(cars)
+
+
+def get_road_tiles(city_map):
+    """Lists every road tile a car might start or finish on, along with the intersections at the ends of its block
+    (both the same if the tile is an intersection itself)
+
+    :param city_map: `Map` object
+    :return:         Arrays of the x and y coordinates of the tiles, and of the ids of the intersections at each end of
+                     their blocks
+    """
+    road_x, road_y, block_end_a, block_end_b = [], [], [], []
+    for row in city_map.tiles:
+        for tile in row:
+            if not tile.is_road:
+                continue
+            if city_map.is_intersection(tile.position):
+                ends = [tile, tile]
+            else:
+                ends = city_map.get_adjacent_intersections(tile.position)
+            road_x.append(tile.position[0])
+            road_y.append(tile.position[1])
+            block_end_a.append(city_map.intersection_ids[ends[0]])
+            block_end_b.append(city_map.intersection_ids[ends[1]])
+    return (np.array(road_x, dtype=np.int32), np.array(road_y, dtype=np.int32),
+            np.array(block_end_a, dtype=np.int32), np.array(block_end_b, dtype=np.int32))
+
+
+def choose_entries_and_exits(engine, starts, destinations):
+    """Picks the ends of the blocks at which cars join and leave the intersection network so that each car's overall
+    route is as short as possible
+
+    :param engine:       `Fleet` or `LinkQueueSimulation` whose road tiles (see `get_road_tiles`), intersections and
+                         routing table to use
+    :param starts:       Array of the indices of the road tiles the cars start on
+    :param destinations: Array of the indices of the road tiles the cars finish on
+    :return:             Arrays of the entry and exit intersection of each car, and a mask of the cars which start and
+                         finish on the same block, and so should drive straight there
+    """
+    start_x, start_y = engine.road_x[starts], engine.road_y[starts]
+    destination_x, destination_y = engine.road_x[destinations], engine.road_y[destinations]
+
+    # Try all four combinations of entry and exit intersections and keep the shortest
+    entries = np.stack([engine.block_end_a[starts], engine.block_end_a[starts],
+                        engine.block_end_b[starts], engine.block_end_b[starts]])
+    exits = np.stack([engine.block_end_a[destinations], engine.block_end_b[destinations],
+                      engine.block_end_a[destinations], engine.block_end_b[destinations]])
+    lengths = (np.abs(engine.intersection_x[entries] - start_x) + np.abs(engine.intersection_y[entries] - start_y) +
+               engine.route_lengths[entries, exits] +
+               np.abs(engine.intersection_x[exits] - destination_x) +
+               np.abs(engine.intersection_y[exits] - destination_y))
+    best = np.argmin(lengths, axis=0)
+    entry = entries[best, np.arange(len(starts))]
+    exit_ = exits[best, np.arange(len(starts))]
+
+    start_is_intersection = engine.block_end_a[starts] == engine.block_end_b[starts]
+    destination_is_intersection = engine.block_end_a[destinations] == engine.block_end_b[destinations]
+    same_block = (~start_is_intersection & ~destination_is_intersection &
+                  (engine.block_end_a[starts] == engine.block_end_a[destinations]) &
+                  (engine.block_end_b[starts] == engine.block_end_b[destinations]))
+    return entry, exit_, same_block
+
+
+def count_cars_ahead(occupied, x, y, target_x, target_y):
+    """Counts the occupied tiles between each position (exclusive) and its target (inclusive), using prefix sums along
+    the rows and columns so that every count is a couple of lookups
+
+    :param occupied: 2D boolean array of which tiles have a car on them, indexed `[y, x]`
+    :param x:        Array of x coordinates
+    :param y:        Array of y coordinates
+    :param target_x: Array of x coordinates of the targets.  Each target must be in the same row or column
+    :param target_y: Array of y coordinates of the targets
+    :return:         Array of the number of occupied tiles in each range
+    """
+    row_sums, column_sums = get_occupancy_sums(occupied)
+    counts = np.zeros(len(x), dtype=np.int32)
+    right = (target_y == y) & (target_x > x)
+    left = (target_y == y) & (target_x < x)
+    down = (target_x == x) & (target_y > y)
+    up = (target_x == x) & (target_y < y)
+    counts[right] = row_sums[y[right], target_x[right] + 1] - row_sums[y[right], x[right] + 1]
+    counts[left] = row_sums[y[left], x[left]] - row_sums[y[left], target_x[left]]
+    counts[down] = column_sums[target_y[down] + 1, x[down]] - column_sums[y[down] + 1, x[down]]
+    counts[up] = column_sums[y[up], x[up]] - column_sums[target_y[up], x[up]]
+    return counts
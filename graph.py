@@ -1,4 +1,6 @@
 from collections import deque, namedtuple
+from heapq import heappop, heappush
+from itertools import count
 
 
 # we'll use infinity as a default distance to nodes.
@@ -17,15 +19,24 @@ class Graph:
         if wrong_edges:
             raise ValueError('Wrong edges data: {}'.format(wrong_edges))
 
-        self.edges = [make_edge(*edge) for edge in edges]
+        # Adjacency is kept up to date as edges are added and removed, so nothing has to be rebuilt from the edge list
+        # when we query the graph.  Maps each vertex to a dict of {neighbour: cost}
+        self.adjacency = {}
+        for edge in edges:
+            edge = make_edge(*edge)
+            self._add_directed_edge(edge.start, edge.end, edge.cost)
+
+    def _add_directed_edge(self, start, end, cost):
+        self.adjacency.setdefault(start, {})[end] = cost
+        self.adjacency.setdefault(end, {})
+
+    @property
+    def edges(self):
+        return [Edge(start, end, cost) for start, ends in self.adjacency.items() for end, cost in ends.items()]
 
     @property
     def vertices(self):
-        return set(
-            sum(
-                ([edge.start, edge.end] for edge in self.edges), []
-            )
-        )
+        return set(self.adjacency)
 
     def get_node_pairs(self, n1, n2, both_ends=True):
         if both_ends:
@@ -35,53 +46,103 @@ class Graph:
         return node_pairs
 
     def remove_edge(self, n1, n2, both_ends=True):
-        node_pairs = self.get_node_pairs(n1, n2, both_ends)
-        edges = self.edges[:]
-        for edge in edges:
-            if [edge.start, edge.end] in node_pairs:
-                self.edges.remove(edge)
+        for start, end in self.get_node_pairs(n1, n2, both_ends):
+            self.adjacency.get(start, {}).pop(end, None)
 
     def add_edge(self, n1, n2, cost=1, both_ends=True):
-        node_pairs = self.get_node_pairs(n1, n2, both_ends)
-        for edge in self.edges:
-            if [edge.start, edge.end] in node_pairs:
+        for start, end in self.get_node_pairs(n1, n2, both_ends):
+            if end in self.adjacency.get(start, {}):
                 return ValueError('Edge {} {} already exists'.format(n1, n2))
 
-        self.edges.append(Edge(start=n1, end=n2, cost=cost))
+        self._add_directed_edge(n1, n2, cost)
         if both_ends:
-            self.edges.append(Edge(start=n2, end=n1, cost=cost))
+            self._add_directed_edge(n2, n1, cost)
 
     @property
     def neighbours(self):
-        neighbours = {vertex: set() for vertex in self.vertices}
-        for edge in self.edges:
-            neighbours[edge.start].add((edge.end, edge.cost))
-
-        return neighbours
-
-    def dijkstra(self, source, dest):
-        assert source in self.vertices, 'Such source node doesn\'t exist'
-        distances = {vertex: inf for vertex in self.vertices}
-        previous_vertices = {
-            vertex: None for vertex in self.vertices
-        }
-        distances[source] = 0
-        vertices = self.vertices.copy()
-
-        while vertices:
-            current_vertex = min(
-                vertices, key=lambda vertex: distances[vertex])
-            vertices.remove(current_vertex)
-            if distances[current_vertex] == inf:
+        return {vertex: set(ends.items()) for vertex, ends in self.adjacency.items()}
+
+    def shortest_path_tree(self, source, dest=None):
+        """Runs Dijkstra's algorithm from `source` using a binary heap
+
+        :param source: Vertex to start from
+        :param dest:   If given, stop as soon as the shortest path to this vertex is known.  Only the vertices whose
+                       shortest paths are known by then are returned
+        :return:       Tuple of (dict of vertex -> distance from `source`, dict of vertex -> previous vertex on the
+                       shortest path from `source`).  Unreachable vertices are left out of both
+        """
+        assert source in self.adjacency, 'Such source node doesn\'t exist'
+        distances = {source: 0}
+        previous_vertices = {source: None}
+        visited = set()
+        # The counter breaks ties between equal distances so that the vertices themselves never get compared
+        counter = count()
+        heap = [(0, next(counter), source)]
+
+        while heap:
+            current_distance, _, current_vertex = heappop(heap)
+            if current_vertex in visited:
+                continue
+            visited.add(current_vertex)
+            if current_vertex == dest:
+                # The vertices still in the heap might yet be reached by a shorter path, so leave them out
+                distances = {vertex: distances[vertex] for vertex in visited}
+                previous_vertices = {vertex: previous_vertices[vertex] for vertex in visited}
                 break
-            for neighbour, cost in self.neighbours[current_vertex]:
+            for neighbour, cost in self.adjacency[current_vertex].items():
+                alternative_route = current_distance + cost
+                if alternative_route < distances.get(neighbour, inf):
+                    distances[neighbour] = alternative_route
+                    previous_vertices[neighbour] = current_vertex
+                    heappush(heap, (alternative_route, next(counter), neighbour))
+
+        return distances, previous_vertices
+
+    def a_star(self, source, dest, heuristic):
+        """Finds the shortest path from `source` to `dest` with A*.  `heuristic` must never overestimate the remaining
+        cost, otherwise the path found might not be the shortest one
+
+        :param source:    Vertex to start from
+        :param dest:      Vertex to find the path to
+        :param heuristic: Function taking a vertex and returning an estimate of its cost to `dest`
+        :return:          Deque of the vertices on the path, or an empty deque if there is no such path
+        """
+        assert source in self.adjacency, 'Such source node doesn\'t exist'
+        distances = {source: 0}
+        previous_vertices = {source: None}
+        visited = set()
+        counter = count()
+        heap = [(heuristic(source), next(counter), source)]
+
+        while heap:
+            _, _, current_vertex = heappop(heap)
+            if current_vertex in visited:
+                continue
+            if current_vertex == dest:
+                break
+            visited.add(current_vertex)
+            for neighbour, cost in self.adjacency[current_vertex].items():
                 alternative_route = distances[current_vertex] + cost
-                if alternative_route < distances[neighbour]:
+                if alternative_route < distances.get(neighbour, inf):
                     distances[neighbour] = alternative_route
                     previous_vertices[neighbour] = current_vertex
+                    heappush(heap, (alternative_route + heuristic(neighbour), next(counter), neighbour))
+
+        return self.get_path_from_tree(previous_vertices, dest)
+
+    def dijkstra(self, source, dest):
+        _, previous_vertices = self.shortest_path_tree(source, dest)
+        return self.get_path_from_tree(previous_vertices, dest)
+
+    def get_path_from_tree(self, previous_vertices, dest):
+        """Walks a shortest path tree (as returned by `shortest_path_tree`) back from `dest` to its root
 
+        :param previous_vertices: Dict of vertex -> previous vertex on the shortest path
+        :param dest:              Vertex to find the path to
+        :return:                  Deque of the vertices on the path, or an empty deque if there is no such path
+        """
         path, current_vertex = deque(), dest
-        while previous_vertices[current_vertex] is not None:
+        while previous_vertices.get(current_vertex) is not None:
             path.appendleft(current_vertex)
             current_vertex = previous_vertices[current_vertex]
         if path:
@@ -0,0 +1,290 @@
+import atexit
+import json
+import os
+import time
+import tracemalloc
+from collections import defaultdict, deque
+from contextlib import nullcontext
+from functools import wraps
+
+from constants import *
+
+# Methods whose calls are counted when call counting is on, by class name
+HOT_METHODS = {
+    'Map': ['get_tile_at_position', 'get_intersection_at_position', 'is_intersection', 'get_adjacent_intersections',
+            'get_route', 'get_next_hop', 'add_car', 'remove_car', 'has_car_going', 'count_cars_between',
+            'count_cars_ahead', 'get_car_ids_between'],
+    'Vehicle': ['move', 'can_move_to_tile', 'get_velocity', 'get_path', 'advance_waypoint',
+                'get_cars_between_me_and_next_intersection'],
+    'TrafficLight': ['change_lights', 'add_car_waiting_on_light'],
+}
+
+# Subsystem that the allocations made in each module are attributed to
+SUBSYSTEMS = {
+    'city_map': 'map',
+    'graph': 'routing',
+    'routing': 'routing',
+    'vehicle_agent': 'movement',
+    'simulation': 'movement',
+    'fleet': 'movement',
+    'mesoscopic': 'movement',
+    'traffic_light': 'lights',
+    'renderer': 'rendering',
+    'vehicle_sim': 'rendering',
+    'trip_log': 'logging',
+    'trip_store': 'logging',
+}
+
+
+def get_subsystem(filename):
+    """Works out which subsystem the code in a file belongs to"""
+    module = os.path.splitext(os.path.basename(filename))[0]
+    if module in SUBSYSTEMS:
+        return SUBSYSTEMS[module]
+    if 'pygame' in filename:
+        return 'rendering'
+    return 'other'
+
+
+class Instrumentation:
+    def __init__(self, enabled=True, count_calls=False, trace_allocations=False, window=INSTRUMENTATION_WINDOW,
+                 allocation_interval=INSTRUMENTATION_ALLOCATION_INTERVAL, output=None, dump_interval=None):
+        """Collects where the time of each tick goes, with little enough overhead to leave on in long runs:
+
+        - the time spent in each phase of a tick (see `phase`), not counting time spent in phases nested inside it
+        - optionally, the number of calls to the hot methods of the map, the cars and the lights (see `HOT_METHODS`)
+        - optionally, the memory allocated by each subsystem, sampled with tracemalloc every `allocation_interval` ticks
+
+        Only the last `window` ticks are kept.  The summary is written to `output` every `dump_interval` ticks and when
+        the interpreter exits (or printed, if there's no `output`)
+
+        :param enabled:             If `False`, nothing is collected and phases cost next to nothing
+        :param count_calls:         Whether to count calls to the hot methods.  This wraps the methods of the classes
+                                    themselves, so it counts the calls made by every instance until `close` is called
+        :param trace_allocations:   Whether to sample allocations with tracemalloc, which slows everything down a lot
+        :param window:              Number of ticks the summary covers
+        :param allocation_interval: Number of ticks between allocation samples
+        :param output:              JSON file to write the summary to
+        :param dump_interval:       Number of ticks between writes of the summary to `output`
+        """
+        self.enabled = enabled
+        self.window = window
+        self.allocation_interval = allocation_interval
+        self.output = output
+        self.dump_interval = dump_interval
+        self.tick_count = 0
+        self.closed = False
+
+        # Stack of [phase name, start time, time spent in nested phases]
+        self.phase_stack = []
+        self.phase_times = defaultdict(float)  # Seconds spent in each phase during the current tick
+        self.tick_start_time = time.perf_counter()
+        self.ticks = deque(maxlen=window)  # Dict of phase -> seconds for each of the last ticks
+        self.tick_times = deque(maxlen=window)  # Total seconds of each of the last ticks
+
+        self.call_counts = defaultdict(int)  # Calls made during the current tick
+        self.calls = deque(maxlen=window)  # Dict of method -> calls for each of the last ticks
+        self.wrapped_methods = []  # (class, name, original method) of each method wrapped to count calls
+
+        self.allocation_snapshot = None
+        self.allocations = deque(maxlen=max(window // allocation_interval, 1))  # Dict of subsystem -> bytes
+        self.memory_by_subsystem = {}
+
+        if not enabled:
+            return
+        if count_calls:
+            self.count_hot_method_calls()
+        if trace_allocations:
+            tracemalloc.start()
+            self.allocation_snapshot = self.take_snapshot()
+        atexit.register(self.close)
+
+    def phase(self, name):
+        """Times a phase of the tick, e.g. `with instrumentation.phase('lights'):`
+
+        :param name: Name of the phase
+        :return:     Context manager
+        """
+        if not self.enabled:
+            return nullcontext()
+        return Phase(self, name)
+
+    def start_phase(self, name):
+        self.phase_stack.append([name, time.perf_counter(), 0.0])
+
+    def end_phase(self):
+        name, start_time, nested_time = self.phase_stack.pop()
+        elapsed = time.perf_counter() - start_time
+        self.phase_times[name] += elapsed - nested_time
+        if self.phase_stack:
+            self.phase_stack[-1][2] += elapsed
+
+    def end_tick(self):
+        """Files away everything collected during the tick.  To be called by whatever drives the simulation, once the
+        tick (including drawing it, if there is a window) is done
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self.ticks.append(dict(self.phase_times))
+        self.tick_times.append(now - self.tick_start_time)
+        self.phase_times.clear()
+        if self.wrapped_methods:
+            self.calls.append(dict(self.call_counts))
+            self.call_counts.clear()
+
+        self.tick_count += 1
+        if self.allocation_snapshot is not None and self.tick_count % self.allocation_interval == 0:
+            self.sample_allocations()
+        if self.output is not None and self.dump_interval and self.tick_count % self.dump_interval == 0:
+            self.dump()
+        # Sampling and dumping aren't part of any tick
+        self.tick_start_time = time.perf_counter()
+
+    def count_hot_method_calls(self):
+        """Wraps the methods in `HOT_METHODS` so that each call is counted"""
+        from city_map import Map
+        from traffic_light import TrafficLight
+        from vehicle_agent import Vehicle
+
+        for cls in (Map, Vehicle, TrafficLight):
+            for name in HOT_METHODS[cls.__name__]:
+                original = cls.__dict__[name]
+                setattr(cls, name, self.make_counting_wrapper(original, f"{cls.__name__}.{name}"))
+                self.wrapped_methods.append((cls, name, original))
+
+    def make_counting_wrapper(self, method, key):
+        call_counts = self.call_counts
+
+        @wraps(method)
+        def counting_wrapper(*args, **kwargs):
+            call_counts[key] += 1
+            return method(*args, **kwargs)
+
+        return counting_wrapper
+
+    def take_snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def sample_allocations(self):
+        """Attributes the memory allocated since the last sample to subsystems"""
+        snapshot = self.take_snapshot()
+        allocated = defaultdict(int)
+        for difference in snapshot.compare_to(self.allocation_snapshot, 'filename'):
+            allocated[get_subsystem(difference.traceback[0].filename)] += difference.size_diff
+        self.allocations.append(dict(allocated))
+
+        memory = defaultdict(int)
+        for statistic in snapshot.statistics('filename'):
+            memory[get_subsystem(statistic.traceback[0].filename)] += statistic.size
+        self.memory_by_subsystem = dict(memory)
+        self.allocation_snapshot = snapshot
+
+    def get_summary(self):
+        """Summarizes the last `window` ticks
+
+        :return: Dict with the time per tick of each phase, the calls per tick of each hot method and the memory held
+                 and allocated by each subsystem
+        """
+        num_ticks = len(self.ticks)
+        total_time = sum(self.tick_times)
+        phases = {}
+        for name in sorted({name for tick in self.ticks for name in tick}):
+            times = [tick.get(name, 0.0) for tick in self.ticks]
+            phases[name] = {'mean_ms': 1000 * sum(times) / num_ticks, 'max_ms': 1000 * max(times),
+                            'share': sum(times) / total_time if total_time else 0.0}
+
+        calls = {}
+        for name in sorted({name for tick in self.calls for name in tick}):
+            calls[name] = sum(tick.get(name, 0) for tick in self.calls) / len(self.calls)
+
+        allocated = defaultdict(int)
+        for sample in self.allocations:
+            for subsystem, size in sample.items():
+                allocated[subsystem] += size
+
+        return {
+            'ticks': self.tick_count,
+            'window': num_ticks,
+            'mean_tick_ms': 1000 * total_time / num_ticks if num_ticks else None,
+            'phases': phases,
+            'calls_per_tick': calls,
+            'memory_bytes': self.memory_by_subsystem,
+            'allocated_bytes_in_window': dict(allocated),
+        }
+
+    def format_summary(self):
+        summary = self.get_summary()
+        if not summary['window']:
+            return "No ticks recorded"
+        lines = [f"Last {summary['window']} of {summary['ticks']} ticks, {summary['mean_tick_ms']:.3f} ms per tick"]
+        for name, stats in sorted(summary['phases'].items(), key=lambda item: -item[1]['mean_ms']):
+            lines.append(f"  {name:<20} {stats['mean_ms']:9.3f} ms mean {stats['max_ms']:9.3f} ms max "
+                         f"{100 * stats['share']:5.1f}%")
+        for name, calls in summary['calls_per_tick'].items():
+            lines.append(f"  {name:<50} {calls:12.1f} calls per tick")
+        for subsystem, size in sorted(summary['memory_bytes'].items()):
+            allocated = summary['allocated_bytes_in_window'].get(subsystem, 0)
+            lines.append(f"  {subsystem:<20} {size / 1024:12.1f} KiB held {allocated / 1024:+12.1f} KiB in window")
+        return "\n".join(lines)
+
+    def dump(self, output=None):
+        """Writes the summary as JSON to `output` (or the file given when this was created), or prints it if there's
+        no file
+        """
+        output = output if output is not None else self.output
+        if output is None:
+            print(self.format_summary())
+            return
+        with open(output, 'w') as outfile:
+            json.dump(self.get_summary(), outfile, indent=2)
+
+    def close(self):
+        """Dumps the summary and undoes everything `__init__` set up.  Safe to call more than once"""
+        if not self.enabled or self.closed:
+            return
+        self.closed = True
+        self.dump()
+        for cls, name, original in self.wrapped_methods:
+            setattr(cls, name, original)
+        self.wrapped_methods = []
+        if self.allocation_snapshot is not None:
+            tracemalloc.stop()
+        atexit.unregister(self.close)
+
+
+class Phase:
+    __slots__ = ('instrumentation', 'name')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.instrumentation.start_phase(self.name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.instrumentation.end_phase()
+
+
+# Shared by everything that isn't being instrumented
+NO_INSTRUMENTATION = Instrumentation(enabled=False)
+
+
+def add_arguments(parser):
+    """Adds the command line options that turn on instrumentation to an `argparse.ArgumentParser`"""
+    parser.add_argument('--instrument', action='store_true', help="Time each phase of every tick")
+    parser.add_argument('--count-calls', action='store_true', help="Also count calls to the hot methods")
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help="Also sample allocations by subsystem with tracemalloc (slow)")
+    parser.add_argument('--instrumentation-output', help="JSON file to write the instrumentation summary to")
+    parser.add_argument('--instrumentation-dump-interval', type=int,
+                        help="Number of ticks between writes of the instrumentation summary")
+
+
+def from_arguments(args):
+    """Makes the `Instrumentation` asked for by the options from `add_arguments`"""
+    if not (args.instrument or args.count_calls or args.trace_allocations):
+        return NO_INSTRUMENTATION
+    return Instrumentation(count_calls=args.count_calls, trace_allocations=args.trace_allocations,
+                           output=args.instrumentation_output, dump_interval=args.instrumentation_dump_interval)
@@ -0,0 +1,277 @@
+import numpy as np
+
+from city_map import make_map
+from fleet import choose_entries_and_exits, get_road_tiles
+from instrumentation import NO_INSTRUMENTATION
+from random_streams import RandomStreams, SPAWN_STREAM, DESTINATION_STREAM
+from constants import *
+from routing import RoutingTable
+from traffic_light import TrafficLightBank
+from trip_log import TripRecord
+
+# What each car is doing: waiting to join the link it starts on, queued on a link, or off the network and driving the
+# rest of the way to its destination
+ENTERING, QUEUED, LEAVING = range(3)
+
+
+class LinkQueueSimulation:
+    def __init__(self, num_cars=NUM_CARS, method=method, seed=None, city_map=None, trip_logger=None,
+                 instrumentation=NO_INSTRUMENTATION):
+        """Mesoscopic alternative to `Simulation` and `Fleet`, for screening scenarios with far more cars than either
+        can move tile by tile.  The road between each pair of neighboring intersections is a link in each direction,
+        and every link is a first-in first-out queue of cars:
+
+        - a car that joins a link reaches its far end after one tick per tile, or half that in flocking mode if there
+          are already cars queued on the link
+        - only the car at the front of the queue can leave, at most one per tick, and only once it's reached the end
+        - it crosses the intersection at the end unless the intersection's light is red for the direction of the link,
+          in which case it counts the tick as waited at a red light (the light is only told about the car when it
+          first arrives), or the next link on its route is full.  A link holds one car per tile between its ends
+        - a car that's been held up by a full link for `LINK_STUCK_TICKS` ticks squeezes onto it anyway, up to twice
+          its capacity.  Without that, a loop of full links that each wait on the next would stay gridlocked for good
+
+        Cars start and finish on random road tiles and follow the map's routing table, like in `Fleet`.  A car joins
+        the network on the link leading to its entry intersection, and once it's crossed its exit intersection it
+        drives the rest of the way without queueing.  Cars which start and finish on the same block drive straight
+        there.  Cars only move into room that was free at the start of the tick, and cars crossing an intersection get
+        into a link before cars joining it from the side of the road
+
+        :param num_cars:        Number of cars to keep on the map at any time
+        :param method:          Navigation method of the cars, either "normal" or "flocking"
+        :param seed:            Seed for placing the cars and picking their destinations (see `RandomStreams`)
+        :param city_map:        `Map` object to drive on.  A new one, whose lights use the same seed, is made if not
+                                given
+        :param trip_logger:     `TripLogger` to record completed trips with, if any
+        :param instrumentation: `Instrumentation` object to time the phases of each tick with
+        """
+        self.method = method
+        self.trip_logger = trip_logger
+        self.instrumentation = instrumentation
+        self.num_cars = num_cars
+        self.streams = RandomStreams(seed)
+        self.city_map = city_map if city_map is not None else make_map(self.streams)
+        if self.city_map.routing_table is None:
+            self.city_map.routing_table = RoutingTable.build(self.city_map)
+        self.spawn_rng = self.streams.get_generator(SPAWN_STREAM)
+        self.destination_rng = self.streams.get_generator(DESTINATION_STREAM)
+        self.tick_count = 0
+        self.trips_completed = 0
+        self.frames_waited_at_red_lights = 0  # Total over all completed trips
+
+        self.load_map(self.city_map)
+        # Like the fleet, the links change their own copy of the map's lights
+        self.lights = TrafficLightBank.from_lights(self.city_map.traffic_lights)
+
+        # State of each car
+        self.state = np.full(num_cars, ENTERING, dtype=np.int8)
+        self.link = np.zeros(num_cars, dtype=np.int32)  # Link the car is queued on, or waiting to join
+        self.entry_distance = np.zeros(num_cars, dtype=np.int32)  # Distance to the end of that link from the start
+        self.ready_tick = np.zeros(num_cars, dtype=np.int64)  # Tick it reaches the end of its link or its destination
+        self.exit_id = np.zeros(num_cars, dtype=np.int32)
+        self.exit_distance = np.zeros(num_cars, dtype=np.int32)  # Distance from the exit to the destination
+        self.at_red_light = np.zeros(num_cars, dtype=bool)  # Whether the light at the end of its link knows about it
+        self.ticks_blocked = np.zeros(num_cars, dtype=np.int32)  # Ticks in a row it's been held up by a full link
+        self.frames_waited = np.zeros(num_cars, dtype=np.int32)
+        self.spawn_tick = np.zeros(num_cars, dtype=np.int64)
+        self.distance_travelled = np.zeros(num_cars, dtype=np.int32)
+
+        # The queue of each link is a ring buffer of car indices: `self.queue[link, self.queue_start[link]]` is the car
+        # at the front, and the buffer wraps around at `self.link_slots[link]`
+        self.queue = np.full((len(self.link_capacity), int(self.link_slots.max(initial=1))), -1, dtype=np.int32)
+        self.queue_start = np.zeros(len(self.link_capacity), dtype=np.int32)
+        self.queue_length = np.zeros(len(self.link_capacity), dtype=np.int32)
+
+        self.spawn(np.arange(num_cars))
+
+    def load_map(self, city_map):
+        """Turns the map into arrays of intersections, links and the road tiles that cars start and finish on"""
+        self.intersection_x = np.array([tile.position[0] for tile in city_map.intersection_tiles], dtype=np.int32)
+        self.intersection_y = np.array([tile.position[1] for tile in city_map.intersection_tiles], dtype=np.int32)
+        self.next_hops = city_map.routing_table.next_hops.astype(np.int32)
+        self.route_lengths = city_map.routing_table.route_lengths
+        self.road_x, self.road_y, self.block_end_a, self.block_end_b = get_road_tiles(city_map)
+
+        light_ids = {light.position: light_id for light_id, light in enumerate(city_map.traffic_lights)}
+
+        # `self.outgoing_link[i, d]` is the link leaving intersection `i` in direction `d`, or -1
+        self.outgoing_link = np.full((len(city_map.intersection_tiles), len(DIRECTIONS)), -1, dtype=np.int32)
+        link_end, link_direction, link_length, link_light = [], [], [], []
+        for tile in city_map.intersection_tiles:
+            for code, direction in enumerate(DIRECTIONS):
+                neighbor = city_map.intersection_neighbors[tile.position][direction]
+                if neighbor is None:
+                    continue
+                self.outgoing_link[city_map.intersection_ids[tile], code] = len(link_end)
+                link_end.append(city_map.intersection_ids[neighbor])
+                link_direction.append(code)
+                link_length.append(abs(neighbor.position[0] - tile.position[0]) +
+                                   abs(neighbor.position[1] - tile.position[1]))
+                link_light.append(light_ids.get(neighbor.position, -1))
+        self.link_end = np.array(link_end, dtype=np.int32)
+        self.link_direction = np.array(link_direction, dtype=np.int8)
+        self.link_length = np.array(link_length, dtype=np.int32)
+        self.link_light = np.array(link_light, dtype=np.int32)  # Light at the end of each link, or -1
+        self.link_capacity = np.maximum(self.link_length - 1, 1)
+        self.link_slots = 2 * self.link_capacity  # Room for the cars that squeeze onto full links
+
+    def get_links(self, from_ids, to_ids):
+        """Gets the links between pairs of neighboring intersections
+
+        :param from_ids: Array of the intersections the links start at
+        :param to_ids:   Array of the intersections the links end at
+        :return:         Array of link indices
+        """
+        dx = self.intersection_x[to_ids] - self.intersection_x[from_ids]
+        dy = self.intersection_y[to_ids] - self.intersection_y[from_ids]
+        directions = np.select([dy < 0, dy > 0, dx < 0], [DIRECTION_CODES[UP], DIRECTION_CODES[DOWN],
+                                                          DIRECTION_CODES[LEFT]], DIRECTION_CODES[RIGHT])
+        return self.outgoing_link[from_ids, directions]
+
+    def spawn(self, cars):
+        """Gives the cars at the indices `cars` a new random start and destination, and sets them off towards the
+        link they join the network on, or straight to their destination if they never need to
+
+        :param cars: Array of car indices
+        """
+        num_new = len(cars)
+        if num_new == 0:
+            return
+        starts = self.spawn_rng.integers(len(self.road_x), size=num_new)
+        destinations = self.destination_rng.integers(len(self.road_x), size=num_new)
+        entry, exit_, same_block = choose_entries_and_exits(self, starts, destinations)
+
+        start_x, start_y = self.road_x[starts], self.road_y[starts]
+        destination_x, destination_y = self.road_x[destinations], self.road_y[destinations]
+        self.exit_id[cars] = exit_
+        self.exit_distance[cars] = (np.abs(self.intersection_x[exit_] - destination_x) +
+                                    np.abs(self.intersection_y[exit_] - destination_y))
+        self.at_red_light[cars] = False
+        self.frames_waited[cars] = 0
+        self.spawn_tick[cars] = self.tick_count
+        self.distance_travelled[cars] = 0
+
+        # A car in the middle of a block joins the link from the far end of its block towards its entry, part of the way
+        # along.  A car on an intersection joins the first link of its route, unless that's also where it leaves
+        start_is_intersection = self.block_end_a[starts] == self.block_end_b[starts]
+        far_end = np.where(entry == self.block_end_a[starts], self.block_end_b[starts], self.block_end_a[starts])
+        first_hop = self.next_hops[entry, exit_]
+        link_from = np.where(start_is_intersection, entry, far_end)
+        link_to = np.where(start_is_intersection, first_hop, entry)
+        entering = ~same_block & ~(start_is_intersection & (entry == exit_))
+        self.state[cars] = np.where(entering, ENTERING, LEAVING)
+        self.link[cars[entering]] = self.get_links(link_from[entering], link_to[entering])
+        self.entry_distance[cars] = (np.abs(self.intersection_x[link_to] - start_x) +
+                                     np.abs(self.intersection_y[link_to] - start_y))
+
+        # The rest drive straight to their destination
+        direct_distance = np.where(same_block, np.abs(destination_x - start_x) + np.abs(destination_y - start_y),
+                                   self.exit_distance[cars])
+        leaving = cars[~entering]
+        self.ready_tick[leaving] = self.tick_count + direct_distance[~entering]
+        self.distance_travelled[leaving] += direct_distance[~entering]
+
+    def step(self):
+        """Advances every car by a single tick and then updates the traffic lights"""
+        phase = self.instrumentation.phase
+        with phase('moves'):
+            self.cross_intersections()
+            entering = np.flatnonzero(self.state == ENTERING)
+            self.join_links(entering, self.link[entering], self.entry_distance[entering], self.link_capacity)
+            arrived = np.flatnonzero((self.state == LEAVING) & (self.ready_tick <= self.tick_count))
+        with phase('spawning'):
+            self.finish_trips(arrived)
+        with phase('lights'):
+            self.lights.update()
+        self.tick_count += 1
+
+    def run(self, num_ticks):
+        for _ in range(num_ticks):
+            self.step()
+            self.instrumentation.end_tick()
+
+    def cross_intersections(self):
+        """Lets the car at the front of each link through the intersection at its end, if it's got there, the light is
+        green and there's room on the next link of its route
+        """
+        links = np.flatnonzero(self.queue_length > 0)
+        cars = self.queue[links, self.queue_start[links]]
+        at_end = self.ready_tick[cars] <= self.tick_count
+        links, cars = links[at_end], cars[at_end]
+
+        lights = self.link_light[links]
+        at_red_light = (lights >= 0) & self.lights.is_red(np.maximum(lights, 0), self.link_direction[links])
+        waiting = cars[at_red_light]
+        self.frames_waited[waiting] += 1
+        # Only add one to the "waiting list" if the car just arrived; don't count subsequent ticks
+        arriving = at_red_light & ~self.at_red_light[cars]
+        self.lights.add_cars_waiting_on_lights(lights[arriving], self.link_direction[links[arriving]])
+        self.at_red_light[waiting] = True
+        links, cars = links[~at_red_light], cars[~at_red_light]
+
+        intersections = self.link_end[links]
+        leaving = intersections == self.exit_id[cars]
+        crossed = leaving.copy()
+        continuing = np.flatnonzero(~leaving)
+        next_hops = self.next_hops[intersections[continuing], self.exit_id[cars[continuing]]]
+        next_links = self.get_links(intersections[continuing], next_hops)
+        joined = self.join_links(cars[continuing], next_links, self.link_length[next_links], self.link_capacity)
+
+        # Cars that have been held up by a full link for long enough squeeze onto it anyway
+        self.ticks_blocked[cars[continuing[~joined]]] += 1
+        stuck = ~joined & (self.ticks_blocked[cars[continuing]] >= LINK_STUCK_TICKS)
+        joined[stuck] = self.join_links(cars[continuing[stuck]], next_links[stuck],
+                                        self.link_length[next_links[stuck]], self.link_slots)
+        crossed[continuing] = joined
+
+        links = links[crossed]
+        self.queue_start[links] = (self.queue_start[links] + 1) % self.link_slots[links]
+        self.queue_length[links] -= 1
+        self.at_red_light[cars[crossed]] = False
+
+        leavers = cars[leaving]
+        self.state[leavers] = LEAVING
+        self.ready_tick[leavers] = self.tick_count + self.exit_distance[leavers]
+        self.distance_travelled[leavers] += self.exit_distance[leavers]
+
+    def join_links(self, cars, links, distances, limits):
+        """Puts cars at the back of the queues of links that have room for them, in the order given
+
+        :param cars:      Array of car indices
+        :param links:     Array of the link each car is joining
+        :param distances: Array of the distance each car has to drive to the end of its link
+        :param limits:    Array of the number of cars each link can hold, indexed by link
+        :return:          Mask of the cars that joined their link
+        """
+        # Rank each car among the cars joining the same link, and let in as many as there's room for
+        order = np.argsort(links, kind='stable')
+        sorted_links = links[order]
+        ranks = np.empty(len(cars), dtype=np.int32)
+        ranks[order] = np.arange(len(cars)) - np.searchsorted(sorted_links, sorted_links)
+        joined = ranks < limits[links] - self.queue_length[links]
+        cars, links, distances, ranks = cars[joined], links[joined], distances[joined], ranks[joined]
+
+        cars_ahead = self.queue_length[links] + ranks
+        travel_ticks = distances
+        if self.method == "flocking":
+            travel_ticks = np.where(cars_ahead > 0, (distances + 1) // 2, distances)
+        self.queue[links, (self.queue_start[links] + cars_ahead) % self.link_slots[links]] = cars
+        self.queue_length += np.bincount(links, minlength=len(self.queue_length)).astype(np.int32)
+
+        self.state[cars] = QUEUED
+        self.link[cars] = links
+        self.ticks_blocked[cars] = 0
+        self.ready_tick[cars] = self.tick_count + travel_ticks
+        self.distance_travelled[cars] += distances
+        return joined
+
+    def finish_trips(self, cars):
+        """Takes the cars that reached their destinations off the map and replaces them with new ones"""
+        self.trips_completed += len(cars)
+        self.frames_waited_at_red_lights += int(self.frames_waited[cars].sum())
+        if self.trip_logger is not None:
+            self.trip_logger.log_trips(
+                TripRecord(frames_waited_at_red_lights=int(self.frames_waited[car]), method=self.method,
+                           trip_ticks=int(self.tick_count - self.spawn_tick[car]),
+                           distance=int(self.distance_travelled[car]), spawn_tick=int(self.spawn_tick[car]),
+                           arrival_tick=self.tick_count) for car in cars)
+        self.spawn(cars)
@@ -0,0 +1,65 @@
+import random
+
+import numpy as np
+
+# Keys of the child streams of a `RandomStreams`.  Every stream is derived from the root seed and its key alone, so
+# adding a light or drawing more numbers from one stream never changes what the others produce
+SPAWN_STREAM = 0
+DESTINATION_STREAM = 1
+LIGHT_STREAM = 2
+SPLIT_STREAM = 3
+
+
+class RandomStreams:
+    def __init__(self, seed=None):
+        """Owns all the randomness of a simulation, split into independent streams: one for where cars spawn, one for
+        their destinations and one for each traffic light.  The same seed always gives bit-identical streams, and
+        `split` hands out independent `RandomStreams` for parallel workers
+
+        :param seed: Int seed, `np.random.SeedSequence` or another `RandomStreams` to share the seed of.  If `None`,
+                     fresh entropy is drawn from the OS, so runs aren't reproducible
+        """
+        if isinstance(seed, RandomStreams):
+            seed = seed.seed_sequence
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.spawn = self.get_random(SPAWN_STREAM)
+        self.destinations = self.get_random(DESTINATION_STREAM)
+
+    @property
+    def seed(self):
+        """Root entropy of the streams, which can be passed back in to reproduce them"""
+        return self.seed_sequence.entropy
+
+    def get_seed_sequence(self, *key):
+        """Gets the seed sequence of the child stream with the given key
+
+        :param key: Ints identifying the stream, starting with one of the `*_STREAM` constants
+        :return:    `np.random.SeedSequence` object
+        """
+        return np.random.SeedSequence(self.seed_sequence.entropy, spawn_key=self.seed_sequence.spawn_key + key)
+
+    def get_random(self, *key):
+        """Gets a `random.Random` generator seeded from the child stream with the given key"""
+        state = self.get_seed_sequence(*key).generate_state(4, dtype=np.uint32)
+        return random.Random(int.from_bytes(state.tobytes(), 'little'))
+
+    def get_generator(self, *key):
+        """Gets a NumPy `Generator` seeded from the child stream with the given key"""
+        return np.random.default_rng(self.get_seed_sequence(*key))
+
+    def get_light_random(self, light_id):
+        """Gets the generator for the timings of the traffic light with the given id"""
+        return self.get_random(LIGHT_STREAM, light_id)
+
+    def get_split(self, index):
+        """Splits off an independent set of streams, e.g. for one replica of an experiment.  Split `index` is always the
+        same for a given seed, so a single replica can be rerun without running the others
+
+        :param index: Number of the split
+        :return:      `RandomStreams` object
+        """
+        return RandomStreams(self.get_seed_sequence(SPLIT_STREAM, index))
+
+    def split(self, count):
+        """Gets the first `count` splits (see `get_split`)"""
+        return [self.get_split(index) for index in range(count)]
@@ -0,0 +1,157 @@
+import pygame
+
+from constants import *
+from fleet import Fleet
+from instrumentation import NO_INSTRUMENTATION
+from traffic_light import LightColor
+
+LIGHT_COLORS = {LightColor.green: GREEN, LightColor.yellow: YELLOW, LightColor.red: RED}
+TRANSPARENT = (255, 0, 255)  # Color key of the light sprites, which no light uses
+
+
+class Renderer:
+    def __init__(self, surface, instrumentation=NO_INSTRUMENTATION):
+        """Draws the state of a simulation onto a pygame surface.  Kept separate from the simulation itself so that the
+        simulation can be run headless, without pygame, a display or a font
+
+        :param surface:         Surface to draw onto (usually the display surface)
+        :param instrumentation: `Instrumentation` object to time the drawing with
+        """
+        self.surface = surface
+        self.instrumentation = instrumentation
+
+        # The roads never change, so the map is drawn once onto its own surface which is then copied onto every frame
+        self.background = None
+        self.background_map = None  # Map that `self.background` shows
+
+        # Cars and lights are drawn from sprites, which are made the first time they're needed
+        self.light_sprites = {}  # Keyed by the colors of a light for traffic heading up, down, left and right
+        self.vehicle_sprites = {}  # Keyed by color
+
+    def draw(self, simulation):
+        """Draws a whole frame: the map, the traffic lights and the cars
+
+        :param simulation: `Simulation` or `Fleet` object whose state should be drawn
+        """
+        phase = self.instrumentation.phase
+        with phase('grid drawing'):
+            if self.background_map is not simulation.city_map:
+                self.background = self.render_background(simulation.city_map)
+                self.background_map = simulation.city_map
+            self.surface.blit(self.background, (0, 0))
+        with phase('light drawing'):
+            self.draw_lights(simulation)
+        with phase('vehicle drawing'):
+            self.draw_vehicles(simulation)
+
+    def render_background(self, city_map):
+        """Draws the parts of the map that never change (the tiles, the roads and the grid lines) onto a new surface
+
+        :param city_map: `Map` object to draw
+        :return:         Surface the size of the one being drawn onto
+        """
+        background = pygame.Surface(self.surface.get_size())
+        if pygame.display.get_surface() is not None:
+            background = background.convert(self.surface)  # Copies much faster when the pixel formats match
+        background.fill(BGCOLOR)
+        self.draw_grid(city_map, background)
+        return background
+
+    def invalidate_background(self):
+        """Makes the map get drawn again on the next frame.  To be called if the roads of the map are changed"""
+        self.background_map = None
+
+    def draw_grid(self, city_map, surface=None):
+        """Draws every tile of the map
+
+        :param city_map: `Map` object to draw
+        :param surface:  Surface to draw onto, the renderer's own by default
+        """
+        surface = surface if surface is not None else self.surface
+        for tile_row in city_map.tiles:
+            for tile in tile_row:
+                x = tile.position[0] * CELLSIZE
+                y = tile.position[1] * CELLSIZE
+
+                tile_rect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
+                pygame.draw.rect(surface, TILE, tile_rect)
+
+                obstacle_or_dirt_rect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
+                if tile.is_road:
+                    pygame.draw.rect(surface, FURNITURE, obstacle_or_dirt_rect)
+
+                pygame.draw.rect(surface, GRAY, tile_rect, 1)  # 1 is the width of the rectangles' outline
+
+    def draw_lights(self, simulation):
+        """Draws every traffic light with a single blit call, using a sprite for each combination of colors
+
+        :param simulation: `Simulation` or `Fleet` object whose lights should be drawn
+        """
+        if isinstance(simulation, Fleet):
+            lights = simulation.lights
+            colors = [lights.get_colors(light_id) for light_id in range(len(lights))]
+            positions = lights.positions
+        else:
+            colors = [(light.up, light.down, light.left, light.right) for light in simulation.city_map.traffic_lights]
+            positions = [light.position for light in simulation.city_map.traffic_lights]
+        self.surface.blits([(self.get_light_sprite(*light_colors), (position[0] * CELLSIZE, position[1] * CELLSIZE))
+                            for light_colors, position in zip(colors, positions)], doreturn=False)
+
+    def get_light_sprite(self, up, down, left, right):
+        """Gets the sprite of a light showing the given colors to traffic heading in each direction, drawing it the
+        first time it's needed
+
+        :return: Surface of a single tile plus the row and column after it, which the edges of the triangles touch.
+                 Transparent where the triangles don't cover it
+        """
+        colors = (up, down, left, right)
+        sprite = self.light_sprites.get(colors)
+        if sprite is None:
+            sprite = self.light_sprites[colors] = self.render_light_sprite(*colors)
+        return sprite
+
+    def render_light_sprite(self, up, down, left, right):
+        sprite = pygame.Surface((CELLSIZE + 1, CELLSIZE + 1))
+        sprite.fill(TRANSPARENT)
+        sprite.set_colorkey(TRANSPARENT)
+
+        top_left     = (0,              0)
+        top_right    = (CELLSIZE,       0)
+        bottom_left  = (0,              CELLSIZE)
+        bottom_right = (CELLSIZE,       CELLSIZE)
+        center       = (0.5 * CELLSIZE, 0.5 * CELLSIZE)
+
+        # Light for traffic heading up...
+        pygame.draw.polygon(sprite, LIGHT_COLORS[up], [bottom_left, center, bottom_right])
+
+        # ...for traffic heading down...
+        pygame.draw.polygon(sprite, LIGHT_COLORS[down], [top_left, top_right, center])
+
+        # ...for traffic heading left...
+        pygame.draw.polygon(sprite, LIGHT_COLORS[left], [center, top_right, bottom_right])
+
+        # ...for traffic heading right...
+        pygame.draw.polygon(sprite, LIGHT_COLORS[right], [bottom_left, top_left, center])
+        return sprite
+
+    def draw_vehicles(self, simulation):
+        """Draws every car with a single blit call, using a sprite for each color of car
+
+        :param simulation: `Simulation` or `Fleet` object whose cars should be drawn
+        """
+        if isinstance(simulation, Fleet):
+            sprite = self.get_vehicle_sprite(DARKORANGE)
+            on_the_road = ~simulation.waiting_to_spawn
+            cars = [(sprite, (x, y)) for x, y in zip((simulation.x[on_the_road] * CELLSIZE).tolist(),
+                                                     (simulation.y[on_the_road] * CELLSIZE).tolist())]
+        else:
+            cars = [(self.get_vehicle_sprite(car.outline_color),
+                     (car.position[0] * CELLSIZE, car.position[1] * CELLSIZE)) for car in simulation.cars]
+        self.surface.blits(cars, doreturn=False)
+
+    def get_vehicle_sprite(self, color):
+        sprite = self.vehicle_sprites.get(color)
+        if sprite is None:
+            sprite = self.vehicle_sprites[color] = pygame.Surface((CELLSIZE, CELLSIZE))
+            sprite.fill(color)
+        return sprite
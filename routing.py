@@ -0,0 +1,164 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from constants import *
+from utilities import *
+
+
+class RouteCache:
+    def __init__(self, max_size=ROUTE_CACHE_SIZE):
+        """Least-recently-used cache of routes between pairs of intersections.  Cars are respawned all the time, so the
+        same pairs of intersections come up over and over again and there's no need to plan their routes every time
+
+        :param max_size: Maximum number of routes to keep before evicting the least recently used one
+        """
+        self.max_size = max_size
+        self.routes = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def get_route(self, start, end, plan_route):
+        """Gets the route from `start` to `end`, planning and caching it if we haven't seen it (recently)
+
+        :param start:      Intersection tile the route starts at
+        :param end:        Intersection tile the route ends at
+        :param plan_route: Function taking `start` and `end` and returning the route between them
+        :return:           Tuple of the intersection tiles along the route, including `start` and `end`
+        """
+        key = (start, end)
+        route = self.routes.get(key)
+        if route is not None:
+            self.hits += 1
+            self.routes.move_to_end(key)
+            return route
+
+        self.misses += 1
+        route = tuple(plan_route(start, end))
+        self.routes[key] = route
+        if len(self.routes) > self.max_size:
+            self.routes.popitem(last=False)
+        return route
+
+    def clear(self):
+        self.routes.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class RoutingTable:
+    def __init__(self, next_hops, route_lengths, signature):
+        """All-pairs routing table for a fixed map.  Rather than planning (or even storing) a route, a car looks up the
+        next intersection to drive to whenever it reaches one
+
+        :param next_hops:     Array where `next_hops[a, b]` is the id of the intersection after `a` on the shortest
+                              route from `a` to `b` (`b` itself if `a == b`, or -1 if `b` can't be reached from `a`)
+        :param route_lengths: Array where `route_lengths[a, b]` is the length of that route (-1 if there isn't one)
+        :param signature:     Signature of the map the table was built for (see `Map.get_signature`)
+        """
+        self.next_hops = next_hops
+        self.route_lengths = route_lengths
+        self.signature = signature
+
+    @classmethod
+    def build(cls, city_map):
+        """Builds the table by growing a shortest path tree from every intersection.  The roads go both ways, so the
+        vertex before `a` in the tree rooted at `b` is the next hop from `a` towards `b`
+
+        :param city_map: `Map` object
+        :return:         `RoutingTable` object
+        """
+        graph = city_map.intersections_graph
+        num_intersections = len(city_map.intersection_tiles)
+        next_hops = np.full((num_intersections, num_intersections), -1, dtype=get_smallest_int_dtype(num_intersections))
+        route_lengths = np.full((num_intersections, num_intersections), -1, dtype=np.int32)
+
+        for destination_id, destination in enumerate(city_map.intersection_tiles):
+            distances, previous_vertices = graph.shortest_path_tree(destination)
+            for intersection, previous in previous_vertices.items():
+                intersection_id = city_map.intersection_ids[intersection]
+                next_hops[intersection_id, destination_id] = (destination_id if previous is None else
+                                                              city_map.intersection_ids[previous])
+                route_lengths[intersection_id, destination_id] = distances[intersection]
+
+        return cls(next_hops, route_lengths, city_map.get_signature())
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data['next_hops'], data['route_lengths'], str(data['signature']))
+
+    @classmethod
+    def load_or_build(cls, city_map, filename):
+        """Loads the table for `city_map` from `filename`, or builds it and saves it there if the file doesn't exist or
+        was built for a different map
+
+        :param city_map: `Map` object
+        :param filename: Where the table is stored between runs
+        :return:         `RoutingTable` object
+        """
+        if os.path.exists(filename):
+            table = cls.load(filename)
+            if table.signature == city_map.get_signature():
+                return table
+
+        table = cls.build(city_map)
+        table.save(filename)
+        return table
+
+    def save(self, filename):
+        # Pass a file object, otherwise numpy insists on adding its own extension to the filename
+        with open(filename, 'wb') as outfile:
+            np.savez_compressed(outfile, next_hops=self.next_hops, route_lengths=self.route_lengths,
+                                signature=np.array(self.signature))
+
+    def get_next_hop(self, intersection_id, destination_id):
+        return int(self.next_hops[intersection_id, destination_id])
+
+    def get_route_length(self, intersection_id, destination_id):
+        return int(self.route_lengths[intersection_id, destination_id])
+
+
+def get_smallest_int_dtype(num_values):
+    """Gets the smallest signed integer type that can hold every id below `num_values` as well as -1
+
+    :param num_values: Number of distinct ids
+    :return:           Numpy dtype
+    """
+    for dtype in (np.int8, np.int16, np.int32):
+        if num_values <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def plan_a_star_route(city_map, start, end):
+    """Plans the shortest route between two intersections with A*.  The roads form a grid, so the Manhattan distance
+    to `end` is exactly the distance left to drive if there's nothing in the way, which makes it an ideal heuristic
+
+    :param city_map: `Map` object
+    :param start:    Intersection tile to start from
+    :param end:      Intersection tile to finish at
+    :return:         List of the intersection tiles along the route, including `start` and `end`
+    """
+    if start is end:
+        return [start]
+
+    route = city_map.intersections_graph.a_star(start, end,
+                                                lambda intersection: manhattan_distance(intersection.position,
+                                                                                        end.position))
+    if not route:
+        raise ValueError(f"Couldn't find a route from {start.position} to {end.position}")
+    return list(route)
+
+
+def get_route_length(route):
+    """Gets the distance driven along a route
+
+    :param route: Sequence of tiles, each in the same row or column as the one before it
+    :return:      Total distance between consecutive tiles
+    """
+    return sum(manhattan_distance(a.position, b.position) for a, b in zip(route, route[1:]))
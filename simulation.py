@@ -0,0 +1,190 @@
+import argparse
+from collections import deque
+
+from vehicle_agent import Vehicle
+from city_map import make_map
+from fleet import Fleet
+from mesoscopic import LinkQueueSimulation
+import instrumentation
+from instrumentation import NO_INSTRUMENTATION
+from random_streams import RandomStreams
+from trip_log import TripLogger, TripRecord
+from constants import *
+
+
+class Simulation:
+    def __init__(self, num_cars=NUM_CARS, method=method, routing_table_file=None, trip_logger=None, seed=None,
+                 city_map=None, instrumentation=NO_INSTRUMENTATION, event_driven=False):
+        """Headless simulation engine.  Holds the map and the cars and advances them one tick at a time, without
+        touching pygame, so it can run as fast as the CPU allows on machines without a display.  Drawing is left to
+        `renderer.Renderer`
+
+        Cars are only ever spawned onto free road tiles.  Once every road tile is taken, cars that are due to be
+        spawned wait in `self.spawn_backlog` until there's room for them
+
+        In event-driven mode, cars that stay stuck are put to sleep (see `Vehicle.fall_asleep`) and skipped until the
+        light or the car in their way changes.  Cars still move in the same order, so the run is the same as without it
+
+        :param num_cars:           Number of cars to keep on the map at any time
+        :param method:             Navigation method of the cars, either "normal" or "flocking"
+        :param routing_table_file: If given, cars follow a precomputed routing table, which is saved to (or reused
+                                   from) this file
+        :param trip_logger:        `TripLogger` to record completed trips with, if any
+        :param seed:               Seed for placing the cars and picking their destinations (see `RandomStreams`), so
+                                   that the same seed and map give the same run
+        :param city_map:           `Map` object to drive on, whose own seed drives its lights.  A new one, whose lights
+                                   use the same seed as the cars, is made if not given
+        :param instrumentation:    `Instrumentation` object to time the phases of each tick with
+        :param event_driven:       Whether to put cars that can't move to sleep
+        """
+        self.method = method
+        self.num_cars = num_cars
+        self.streams = RandomStreams(seed)
+        self.city_map = city_map if city_map is not None else make_map(self.streams)
+        if routing_table_file is not None:
+            self.city_map.load_routing_table(routing_table_file)
+        self.trip_logger = trip_logger
+        self.instrumentation = instrumentation
+        self.tick_count = 0
+        self.trips_completed = 0
+        self.frames_waited_at_red_lights = 0  # Total over all completed trips
+        self.event_driven = event_driven
+
+        self.cars = []  # In order of id, since cars are numbered as they're created
+        self.spawn_backlog = deque([self.tick_count] * num_cars)  # Tick on which each car waiting to spawn was due
+        self.spawn_vehicles()
+
+    def spawn_vehicle(self):
+        return Vehicle(ORANGE, DARKORANGE, self.city_map, method=self.method, spawn_tick=self.tick_count,
+                       streams=self.streams)
+
+    def spawn_vehicles(self):
+        """Spawns as many of the cars in the spawn backlog as there are free road tiles for, in order"""
+        for _ in range(min(len(self.spawn_backlog), len(self.city_map.free_road_tiles))):
+            self.spawn_backlog.popleft()
+            self.cars.append(self.spawn_vehicle())
+
+    def finish_trip(self, car):
+        """Records the trip of a car that reached its destination and takes it off the map"""
+        self.trips_completed += 1
+        self.frames_waited_at_red_lights += car.frames_waited_at_red_lights
+        if self.trip_logger is not None:
+            self.trip_logger.log_trip(TripRecord(frames_waited_at_red_lights=car.frames_waited_at_red_lights,
+                                                 method=car.method, trip_ticks=self.tick_count - car.spawn_tick,
+                                                 distance=car.distance_travelled, spawn_tick=car.spawn_tick,
+                                                 arrival_tick=self.tick_count))
+        car.destroy()
+
+    def step(self):
+        """Advances the simulation by a single tick: moves every car, replaces the ones that arrived and then updates
+        the traffic lights.  New cars are spawned together once every car has moved
+        """
+        phase = self.instrumentation.phase
+        with phase('moves'):
+            if self.method == "flocking":
+                self.city_map.update_cars_ahead_counts()
+            if self.event_driven:
+                self.move_awake_cars()
+            else:
+                for car in self.cars:
+                    car.move(self.city_map)
+
+        with phase('spawning'):
+            if any(car.destination_reached for car in self.cars):
+                for car in self.cars:
+                    if car.destination_reached:
+                        self.finish_trip(car)
+                        # Create a new car in its stead
+                        self.spawn_backlog.append(self.tick_count)
+                self.cars = [car for car in self.cars if not car.destination_reached]
+            self.spawn_vehicles()
+
+        with phase('lights'):
+            self.city_map.update_traffic_lights()
+        if self.city_map.woken_cars:
+            self.wake_cars()
+        self.tick_count += 1
+
+    def move_awake_cars(self):
+        """Moves the cars that aren't asleep, putting the ones that stay stuck to sleep.  A car woken by a car that
+        moves before it gets moved on this tick, just as if it had never been asleep
+        """
+        city_map = self.city_map
+        for car in self.cars:
+            if car.asleep_since is not None:
+                continue
+            car.move(city_map)
+            if city_map.woken_cars:
+                self.wake_cars(car.id)
+            if car.destination_reached or car.previous_position != car.position:
+                car.ticks_blocked = 0
+            else:
+                car.ticks_blocked += 1
+                # Most cars that get blocked move again straight away, so only the ones that stay stuck are worth the
+                # cost of putting to sleep and waking up
+                if car.ticks_blocked >= SLEEP_AFTER_TICKS_BLOCKED:
+                    car.fall_asleep(self.tick_count)
+
+    def wake_cars(self, moving_car_id=None):
+        """Wakes the cars in the map's `woken_cars`
+
+        :param moving_car_id: Id of the car that has just moved, if cars are being moved.  Cars after it in
+                              `self.cars` get moved on this tick, the others on the next one
+        """
+        for car in self.city_map.woken_cars:
+            if car.asleep_since is None:
+                continue  # Already woken by something else
+            if moving_car_id is not None and car.id > moving_car_id:
+                car.wake_up(self.tick_count)
+            else:
+                car.wake_up(self.tick_count + 1)
+        self.city_map.woken_cars.clear()
+
+    def run(self, num_ticks):
+        """Runs the simulation for a fixed number of ticks
+
+        :param num_ticks: How many ticks to advance the simulation by
+        """
+        for _ in range(num_ticks):
+            self.step()
+            self.instrumentation.end_tick()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the traffic simulation without a window")
+    parser.add_argument('--ticks', type=int, default=10000, help="Number of ticks to simulate")
+    parser.add_argument('--cars', type=int, default=NUM_CARS, help="Number of cars on the map")
+    parser.add_argument('--method', choices=["normal", "flocking"], default=method, help="Navigation method")
+    parser.add_argument('--routing-table', help="File to save or reuse the map's routing table from")
+    parser.add_argument('--engine', choices=["objects", "events", "fleet", "mesoscopic"], default="objects",
+                        help="Simulate each car as a `Vehicle` object (skipping the ones that can't move with "
+                             "\"events\"), the whole fleet at once with NumPy, or every block as a queue of cars")
+    parser.add_argument('--log', default=logfile_name,
+                        help="File to append the completed trips to, in the columnar format of trip_store.py if it "
+                             f"ends in {TRIP_STORE_EXTENSION}")
+    parser.add_argument('--seed', type=int, help="Seed for a reproducible run")
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+
+    trip_logger = TripLogger(args.log, metadata={'engine': args.engine, 'cars': args.cars, 'ticks': args.ticks,
+                                                 'method': args.method})
+    if args.engine in ("fleet", "mesoscopic"):
+        streams = RandomStreams(args.seed)
+        city_map = make_map(streams)
+        if args.routing_table is not None:
+            city_map.load_routing_table(args.routing_table)
+        engine = Fleet if args.engine == "fleet" else LinkQueueSimulation
+        simulation = engine(num_cars=args.cars, method=args.method, seed=streams, city_map=city_map,
+                            trip_logger=trip_logger, instrumentation=instrumentation.from_arguments(args))
+    else:
+        simulation = Simulation(num_cars=args.cars, method=args.method, routing_table_file=args.routing_table,
+                                trip_logger=trip_logger, seed=args.seed,
+                                instrumentation=instrumentation.from_arguments(args),
+                                event_driven=args.engine == "events")
+    simulation.run(args.ticks)
+    simulation.instrumentation.close()
+    trip_logger.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import numpy as np
+
+from fleet import Fleet
+
+
+def count_cars_on_tiles(fleet):
+    """Counts the cars on the road at each tile, indexed `[y, x]`"""
+    on_the_road = np.flatnonzero(~fleet.waiting_to_spawn)
+    counts = np.zeros((fleet.height, fleet.width), dtype=np.int32)
+    np.add.at(counts, (fleet.y[on_the_road], fleet.x[on_the_road]), 1)
+    return counts
+
+
+def test_spawns_only_onto_free_tiles():
+    # More cars than road tiles, so that every tick some cars wait for room and the rest take the few free tiles
+    fleet = Fleet(num_cars=3000, seed=1)
+    assert fleet.waiting_to_spawn.any()
+    assert (count_cars_on_tiles(fleet) <= 1).all()
+    # After the first tick, the cars spawned on it can't be told apart from the ones spawned before it
+    fleet.step()
+    spawned = 0
+    for _ in range(200):
+        fleet.step()
+        # Cars are spawned once every car has moved, so the new ones are still where they were put
+        cars_on_tiles = count_cars_on_tiles(fleet)
+        new_cars = np.flatnonzero(~fleet.waiting_to_spawn & (fleet.spawn_tick == fleet.tick_count - 1))
+        assert (cars_on_tiles[fleet.y[new_cars], fleet.x[new_cars]] == 1).all()
+        spawned += len(new_cars)
+    assert spawned > 0
+
+
+def test_cars_holding_matches_cars():
+    fleet = Fleet(num_cars=1000, seed=0, method="flocking")
+    for _ in range(100):
+        fleet.step()
+        on_the_road = np.flatnonzero(~fleet.waiting_to_spawn)
+        cars_holding = np.zeros_like(fleet.cars_holding)
+        np.add.at(cars_holding, (fleet.direction[on_the_road], fleet.y[on_the_road], fleet.x[on_the_road]), 1)
+        assert np.array_equal(cars_holding, fleet.cars_holding)
@@ -0,0 +1,25 @@
+from collections import Counter
+
+from simulation import Simulation
+from vehicle_agent import Vehicle
+
+
+def test_every_car_moves_once_per_tick(monkeypatch):
+    simulation = Simulation(num_cars=100, seed=1)
+    moves = Counter()
+    move = Vehicle.move
+
+    def counting_move(car, city_map):
+        moves[car.id] += 1
+        return move(car, city_map)
+
+    monkeypatch.setattr(Vehicle, 'move', counting_move)
+    arrivals = 0
+    for _ in range(300):
+        cars = list(simulation.cars)
+        moves.clear()
+        simulation.step()
+        assert all(moves[car.id] == 1 for car in cars)
+        arrivals += sum(car.destination_reached for car in cars)
+    assert arrivals > 0
+    assert len(simulation.cars) == 100
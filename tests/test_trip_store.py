@@ -0,0 +1,14 @@
+from trip_log import TripRecord
+from trip_store import TripStore, TripStoreWriter
+
+
+def test_appended_runs_keep_their_metadata(tmp_path):
+    filename = str(tmp_path / 'trips.trips')
+    for run, method in enumerate(["normal", "flocking"]):
+        writer = TripStoreWriter(filename, metadata={'engine': 'fleet', 'method': method})
+        writer.write([TripRecord(run, method, 10, 5, 0, 10)] * (run + 1))
+
+    store = TripStore(filename)
+    assert [run['method'] for run in store.runs] == ["normal", "flocking"]
+    assert [(chunk['run'], len(chunk['method'])) for chunk in store.chunks()] == [(0, 1), (1, 2)]
+    assert store.aggregate_by_method()['flocking']['count'] == 2
@@ -1,9 +1,12 @@
 import enum
 import random
-from copy import deepcopy
+from heapq import heappush, heappop
+from itertools import count
 
 import math
 
+import numpy as np
+
 from constants import *
 
 
@@ -14,26 +17,40 @@ class LightColor(enum.Enum):
 
 
 class TrafficLight:
-    def __init__(self, position):
+    __slots__ = ('up', 'down', 'left', 'right', 'position', 'yellow_duration', 'up_and_down_time_until_light_change',
+                 'left_and_right_time_until_light_change', 'car_is_waiting_on_light', 'rng', 'controller', 'timer_tick',
+                 'next_change_tick')
+
+    def __init__(self, position, rng=None):
         """These directions represent the color for a car travelling in the given direction.  E.g., a car travelling
         right would look at `self.right`
+
+        :param position: Position of the intersection the light is at
+        :param rng:      `random.Random` generator for the light's green durations, the global `random` by default
         """
         self.up = LightColor.green
         self.down = LightColor.green
         self.left = LightColor.red
         self.right = LightColor.red
 
-        self.position = deepcopy(position)
+        self.position = position
+        self.rng = rng if rng is not None else random
 
         self.yellow_duration = 6
 
         # Since lights facing in opposite directions should always change together, we use a single timer for each pair
-        self.up_and_down_time_until_light_change = random.randint(40, 60)
+        self.up_and_down_time_until_light_change = self.rng.randint(40, 60)
         self.left_and_right_time_until_light_change = math.inf
 
         # Used to change lights more quickly when cars are waiting at a red light
         self.car_is_waiting_on_light = self.reset_cars_waiting_on_lights()
 
+        # Set by a `LightController`, which only counts the timers down when it needs to know their value.  Until
+        # then, they hold their value as of the controller's tick `timer_tick`
+        self.controller = None
+        self.timer_tick = 0
+        self.next_change_tick = None
+
     def reset_cars_waiting_on_lights(self):
         return {UP: 0, DOWN: 0, LEFT: 0, RIGHT: 0}
 
@@ -44,7 +61,13 @@ class TrafficLight:
         """
         # if direction_of_travel == UP:
         #     self.car_is_waiting_on_light[UP] += 1
-        self.car_is_waiting_on_light[direction_of_travel] += 1
+        if self.controller is not None:
+            # The timer counts down faster from now on, so bring it up to date and work out when the light changes again
+            self.controller.catch_up(self)
+            self.car_is_waiting_on_light[direction_of_travel] += 1
+            self.controller.schedule(self)
+        else:
+            self.car_is_waiting_on_light[direction_of_travel] += 1
 
     def get_rgb_color_value(self, light_color):
         if light_color == LightColor.green:
@@ -70,47 +93,84 @@ class TrafficLight:
         handle how frequently to change the lights
         """
         if self.up_and_down_time_until_light_change >= 0:
-            # Lights change faster depending on how many cars are waiting on them
-            self.up_and_down_time_until_light_change -= (
-                        1 + self.car_is_waiting_on_light[LEFT] + self.car_is_waiting_on_light[RIGHT])
+            self.up_and_down_time_until_light_change -= self.get_up_and_down_countdown_rate()
         else:
-            self.car_is_waiting_on_light = self.reset_cars_waiting_on_lights()
-            self.up = self.get_next_light_color(self.up)
-            self.down = self.get_next_light_color(self.down)
-            assert self.up == self.down
+            self.change_up_and_down_lights()
+            return
 
-            # If the lights turned red, then turn the other lights green
-            if self.up == LightColor.red:
-                self.left = self.get_next_light_color(self.left)
-                self.right = self.get_next_light_color(self.right)
-                assert self.left == self.right
+        if self.left_and_right_time_until_light_change >= 0:
+            self.left_and_right_time_until_light_change -= self.get_left_and_right_countdown_rate()
+        else:
+            self.change_left_and_right_lights()
+            return
 
-                self.left_and_right_time_until_light_change = self.get_light_duration(self.left)
+    def get_up_and_down_countdown_rate(self):
+        # Lights change faster depending on how many cars are waiting on them
+        return 1 + self.car_is_waiting_on_light[LEFT] + self.car_is_waiting_on_light[RIGHT]
 
-            self.up_and_down_time_until_light_change = self.get_light_duration(self.up)
+    def get_left_and_right_countdown_rate(self):
+        return 1 + self.car_is_waiting_on_light[UP] + self.car_is_waiting_on_light[DOWN]
 
-            return
+    def change_up_and_down_lights(self):
+        self.car_is_waiting_on_light = self.reset_cars_waiting_on_lights()
+        self.up = self.get_next_light_color(self.up)
+        self.down = self.get_next_light_color(self.down)
+        assert self.up == self.down
 
-        if self.left_and_right_time_until_light_change >= 0:
-            self.left_and_right_time_until_light_change -= (
-                        1 + self.car_is_waiting_on_light[UP] + self.car_is_waiting_on_light[DOWN])
-        else:
-            self.car_is_waiting_on_light = self.reset_cars_waiting_on_lights()
+        # If the lights turned red, then turn the other lights green
+        if self.up == LightColor.red:
             self.left = self.get_next_light_color(self.left)
             self.right = self.get_next_light_color(self.right)
             assert self.left == self.right
 
-            # If the lights turned red, then turn the other lights green
-            if self.left == LightColor.red:
-                self.up = self.get_next_light_color(self.up)
-                self.down = self.get_next_light_color(self.down)
-                assert self.up == self.down
+            self.left_and_right_time_until_light_change = self.get_light_duration(self.left)
 
-                self.up_and_down_time_until_light_change = self.get_light_duration(self.up)
+        self.up_and_down_time_until_light_change = self.get_light_duration(self.up)
 
-            self.left_and_right_time_until_light_change = self.get_light_duration(self.left)
+    def change_left_and_right_lights(self):
+        self.car_is_waiting_on_light = self.reset_cars_waiting_on_lights()
+        self.left = self.get_next_light_color(self.left)
+        self.right = self.get_next_light_color(self.right)
+        assert self.left == self.right
 
-            return
+        # If the lights turned red, then turn the other lights green
+        if self.left == LightColor.red:
+            self.up = self.get_next_light_color(self.up)
+            self.down = self.get_next_light_color(self.down)
+            assert self.up == self.down
+
+            self.up_and_down_time_until_light_change = self.get_light_duration(self.up)
+
+        self.left_and_right_time_until_light_change = self.get_light_duration(self.left)
+
+    def change_lights(self):
+        """Changes whichever pair of lights is counting down (the other pair is red and waits on it)"""
+        if self.up_and_down_time_until_light_change != math.inf:
+            self.change_up_and_down_lights()
+        else:
+            self.change_left_and_right_lights()
+
+    def count_down(self, ticks):
+        """Counts the timer of the pair of lights that isn't red down by `ticks` ticks, as `change_lights_possibly`
+        would have done if it had been called that many times without the lights changing
+        """
+        if self.up_and_down_time_until_light_change != math.inf:
+            self.up_and_down_time_until_light_change -= ticks * self.get_up_and_down_countdown_rate()
+        else:
+            self.left_and_right_time_until_light_change -= ticks * self.get_left_and_right_countdown_rate()
+
+    def get_ticks_until_change(self):
+        """Works out how many more calls of `change_lights_possibly` it would take for the lights to change, if no more
+        cars start waiting on them
+        """
+        if self.up_and_down_time_until_light_change != math.inf:
+            timer, rate = self.up_and_down_time_until_light_change, self.get_up_and_down_countdown_rate()
+        else:
+            timer, rate = self.left_and_right_time_until_light_change, self.get_left_and_right_countdown_rate()
+        # The timer counts down on each call while it's at least 0, and the lights change on the call after that
+        if timer < 0:
+            return 1
+        return timer // rate + 2
 
     def get_next_light_color(self, light_color):
         if light_color == LightColor.green:
@@ -122,28 +182,194 @@ class TrafficLight:
 
     def get_light_duration(self, light_color):
         if light_color == LightColor.green:
-            return random.randint(40, 60)
+            return self.rng.randint(40, 60)
         elif light_color == LightColor.yellow:
             return self.yellow_duration
         # Red lights wait on lights in other direction to become red before changing
         elif light_color == LightColor.red:
             return math.inf
 
-    def draw(self):
-        top_left     = (self.position['x'] * CELLSIZE,                  self.position['y'] * CELLSIZE)
-        top_right    = (self.position['x'] * CELLSIZE + CELLSIZE,       self.position['y'] * CELLSIZE)
-        bottom_left  = (self.position['x'] * CELLSIZE,                  self.position['y'] * CELLSIZE + CELLSIZE)
-        bottom_right = (self.position['x'] * CELLSIZE + CELLSIZE,       self.position['y'] * CELLSIZE + CELLSIZE)
-        center       = (self.position['x'] * CELLSIZE + 0.5 * CELLSIZE, self.position['y'] * CELLSIZE + 0.5 * CELLSIZE)
 
-        # Light for traffic heading up...
-        pygame.draw.polygon(DISPLAYSURF, self.get_rgb_color_value(self.up), [bottom_left, center, bottom_right])
+class LightController:
+    def __init__(self, lights):
+        """Changes a set of traffic lights exactly when `TrafficLight.change_lights_possibly` would if it were called
+        on every light every tick, but without touching the lights in between.  Each light's next change is kept in a
+        priority queue, and only recomputed when a car starts waiting on the light and speeds its timer up
+
+        :param lights: List of `TrafficLight` objects to control
+        """
+        self.tick = 0  # Number of times `update` has been called
+        self.queue = []  # Heap of (tick of the change, sequence number, light); stale entries are skipped
+        self.sequence_numbers = count()
+        for light in lights:
+            light.controller = self
+            light.timer_tick = self.tick
+            self.schedule(light)
+
+    def catch_up(self, light):
+        """Brings a light's timer up to date with the current tick"""
+        light.count_down(self.tick - light.timer_tick)
+        light.timer_tick = self.tick
+
+    def schedule(self, light):
+        """Works out when a light whose timer is up to date changes next"""
+        light.next_change_tick = self.tick + light.get_ticks_until_change()
+        heappush(self.queue, (light.next_change_tick, next(self.sequence_numbers), light))
+
+    def update(self):
+        """Advances by one tick, changing the lights that are due
+
+        :return: List of the lights that changed
+        """
+        self.tick += 1
+        changed = []
+        while self.queue and self.queue[0][0] <= self.tick:
+            change_tick, _, light = heappop(self.queue)
+            if change_tick != light.next_change_tick:
+                continue  # The light has been rescheduled since
+            light.change_lights()
+            light.timer_tick = self.tick
+            self.schedule(light)
+            changed.append(light)
+        return changed
+
+
+# Phases of a pair of lights in a `TrafficLightBank`, in the order they cycle through
+GREEN_PHASE, YELLOW_PHASE, RED_PHASE = range(3)
+PHASE_COLORS = [LightColor.green, LightColor.yellow, LightColor.red]
+# Which pair of lights (0 for up and down, 1 for left and right) each direction in `DIRECTIONS` looks at
+DIRECTION_AXES = np.array([0 if direction in (UP, DOWN) else 1 for direction in DIRECTIONS], dtype=np.intp)
+
+
+class TrafficLightBank:
+    def __init__(self, positions, rngs, yellow_duration=6, phases=None, timers=None, waiting=None):
+        """Keeps the state of many traffic lights in NumPy arrays and changes them all at once, following the same
+        rules as `TrafficLight.change_lights_possibly`.  Lights are referred to by their index, and each pair of lights
+        (up and down, or left and right) by its axis, 0 or 1
+
+        :param positions:       List of the position of each light
+        :param rngs:            List of a `random.Random` generator for the green durations of each light
+        :param yellow_duration: Number of ticks lights stay yellow for
+        :param phases:          Array of the phase of each pair of lights.  By default every light starts off green
+                                for up and down, as in `TrafficLight`
+        :param timers:          Array of the time left until each pair of lights changes.  Drawn from `rngs` by default
+        :param waiting:         Array of the number of cars waiting on each light in each direction, zero by default
+        """
+        self.positions = positions
+        self.rngs = rngs
+        self.yellow_duration = yellow_duration
+
+        if phases is None:
+            phases = np.array([[GREEN_PHASE, RED_PHASE]] * len(positions), dtype=np.int8).reshape(-1, 2)
+        if timers is None:
+            timers = np.array([[rng.randint(40, 60), math.inf] for rng in rngs], dtype=float).reshape(-1, 2)
+        if waiting is None:
+            waiting = np.zeros((len(positions), len(DIRECTIONS)), dtype=np.int32)
+        self.phases = phases
+        self.timers = timers
+        self.waiting = waiting  # Indexed by `DIRECTIONS`
+
+    @classmethod
+    def from_lights(cls, lights):
+        """Makes a bank with the current state of some `TrafficLight` objects, which carries on using their generators
+
+        :param lights: List of `TrafficLight` objects
+        :return:       `TrafficLightBank` object
+        """
+        for light in lights:
+            if light.controller is not None:
+                light.controller.catch_up(light)
+        phases = np.array([[PHASE_COLORS.index(light.up), PHASE_COLORS.index(light.left)] for light in lights],
+                          dtype=np.int8).reshape(-1, 2)
+        timers = np.array([[light.up_and_down_time_until_light_change, light.left_and_right_time_until_light_change]
+                           for light in lights], dtype=float).reshape(-1, 2)
+        waiting = np.array([[light.car_is_waiting_on_light[direction] for direction in DIRECTIONS]
+                            for light in lights], dtype=np.int32).reshape(-1, len(DIRECTIONS))
+        yellow_duration = lights[0].yellow_duration if lights else 6
+        return cls([light.position for light in lights], [light.rng for light in lights], yellow_duration, phases,
+                   timers, waiting)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def get_red_lights(self):
+        """Gets which lights are red, as an array where `red[light_id, d]` is `True` if the light is red for cars
+        travelling in direction `DIRECTIONS[d]`
+        """
+        return self.phases[:, DIRECTION_AXES] == RED_PHASE
+
+    def is_red(self, light_ids, directions):
+        """Checks whether each light is red for cars travelling in the matching direction
+
+        :param light_ids:  Array of light indices
+        :param directions: Array of indices into `DIRECTIONS`, the same length as `light_ids`
+        :return:           Boolean array
+        """
+        return self.phases[light_ids, DIRECTION_AXES[directions]] == RED_PHASE
 
-        # ...for traffic heading down...
-        pygame.draw.polygon(DISPLAYSURF, self.get_rgb_color_value(self.down), [top_left, top_right, center])
+    def get_colors(self, light_id):
+        """Gets the `LightColor`s of a light for traffic heading up, down, left and right"""
+        up_and_down, left_and_right = self.phases[light_id]
+        return (PHASE_COLORS[up_and_down], PHASE_COLORS[up_and_down], PHASE_COLORS[left_and_right],
+                PHASE_COLORS[left_and_right])
 
-        # ...for traffic heading left...
-        pygame.draw.polygon(DISPLAYSURF, self.get_rgb_color_value(self.left), [center, top_right, bottom_right])
+    def add_cars_waiting_on_lights(self, light_ids, directions):
+        """Counts cars that have just arrived at red lights, like `TrafficLight.add_car_waiting_on_light`
 
-        # ...for traffic heading right...
-        pygame.draw.polygon(DISPLAYSURF, self.get_rgb_color_value(self.right), [bottom_left, top_left, center])
+        :param light_ids:  Array of the index of the light each car is waiting on
+        :param directions: Array of the index in `DIRECTIONS` of the direction each car is travelling in
+        """
+        np.add.at(self.waiting, (light_ids, directions), 1)
+
+    def update(self):
+        """Advances every light by one tick"""
+        # A pair of lights counts down faster for every car waiting on the red lights of the other pair
+        rates = np.stack([1 + self.waiting[:, DIRECTION_CODES[LEFT]] + self.waiting[:, DIRECTION_CODES[RIGHT]],
+                          1 + self.waiting[:, DIRECTION_CODES[UP]] + self.waiting[:, DIRECTION_CODES[DOWN]]], axis=1)
+
+        # The up and down lights are dealt with first, and the left and right lights are left alone on ticks when the
+        # up and down lights change
+        changing_up_and_down = self.timers[:, 0] < 0
+        counting_down = ~changing_up_and_down
+        self.timers[counting_down, 0] -= rates[counting_down, 0]
+        changing_left_and_right = counting_down & (self.timers[:, 1] < 0)
+        counting_down &= ~changing_left_and_right
+        self.timers[counting_down, 1] -= rates[counting_down, 1]
+
+        self.change_lights(changing_up_and_down, 0)
+        self.change_lights(changing_left_and_right, 1)
+
+    def change_lights(self, changing, axis):
+        """Moves a pair of lights on to their next color, like `TrafficLight.change_up_and_down_lights` and
+        `TrafficLight.change_left_and_right_lights`
+
+        :param changing: Mask of the lights to change
+        :param axis:     Which pair of lights to change
+        """
+        if not changing.any():
+            return
+        other_axis = 1 - axis
+        self.waiting[changing] = 0
+        self.phases[changing, axis] = (self.phases[changing, axis] + 1) % len(PHASE_COLORS)
+
+        # If the lights turned red, then turn the other lights green
+        turned_red = changing & (self.phases[:, axis] == RED_PHASE)
+        self.phases[turned_red, other_axis] = (self.phases[turned_red, other_axis] + 1) % len(PHASE_COLORS)
+        self.timers[turned_red, other_axis] = self.get_light_durations(turned_red, other_axis)
+
+        self.timers[changing, axis] = self.get_light_durations(changing, axis)
+
+    def get_light_durations(self, lights, axis):
+        """Gets how long each light stays in its current phase, like `TrafficLight.get_light_duration`
+
+        :param lights: Mask of the lights
+        :param axis:   Which pair of lights
+        :return:       Array of durations, one for each light in the mask
+        """
+        phases = self.phases[lights, axis]
+        durations = np.where(phases == YELLOW_PHASE, self.yellow_duration, math.inf)
+        # Red lights wait on the lights in the other direction to become red before changing
+        for i, light_id in enumerate(np.flatnonzero(lights)):
+            if phases[i] == GREEN_PHASE:
+                durations[i] = self.rngs[light_id].randint(40, 60)
+        return durations
@@ -0,0 +1,106 @@
+import atexit
+import csv
+import threading
+from collections import namedtuple
+
+from constants import *
+from trip_store import TripStoreWriter
+
+# One completed trip.  The first two fields are the columns `waiting_times.csv` has always had, so older analyses keep
+# working on new logs
+TripRecord = namedtuple('TripRecord', 'frames_waited_at_red_lights, method, trip_ticks, distance, spawn_tick, '
+                                      'arrival_tick')
+
+
+class CsvTripWriter:
+    def __init__(self, filename):
+        """Appends trips to a CSV file, one row per trip with no header
+
+        :param filename: CSV file
+        """
+        self.filename = filename
+
+    def write(self, records):
+        with open(self.filename, 'a', newline='') as outfile:
+            writer = csv.writer(outfile, delimiter=',')
+            writer.writerows(records)
+
+    def close(self):
+        pass
+
+
+def open_trip_writer(filename, metadata=None):
+    """Picks the writer for a trip log from its extension: files ending in `TRIP_STORE_EXTENSION` use the columnar trip
+    store format and everything else is CSV
+
+    :param filename: File to append the trips to
+    :param metadata: Dict of information about the run, kept with its trips in a trip store
+    :return:         Object with `write(records)` and `close()` methods
+    """
+    if filename.endswith(TRIP_STORE_EXTENSION):
+        return TripStoreWriter(filename, metadata)
+    return CsvTripWriter(filename)
+
+
+class TripLogger:
+    def __init__(self, filename=logfile_name, batch_size=TRIP_LOG_BATCH_SIZE, flush_interval=TRIP_LOG_FLUSH_INTERVAL,
+                 metadata=None, writer=None):
+        """Collects completed trips in memory and appends them to `filename` in batches from a background thread, so
+        that logging never holds up the simulation.  A batch is written once `batch_size` trips are waiting or
+        `flush_interval` seconds have passed, whichever comes first.  Whatever is left is written by `close`, which
+        also runs when the interpreter exits
+
+        :param filename:       File to append the trips to, either CSV or a trip store (see `open_trip_writer`)
+        :param batch_size:     Number of trips to collect before writing them
+        :param flush_interval: Maximum number of seconds trips wait in memory
+        :param metadata:       Dict of information about the run, kept with its trips in a trip store
+        :param writer:         Object with `write(records)` and `close()` methods to use instead of opening `filename`
+        """
+        self.filename = filename
+        self.writer = writer or open_trip_writer(filename, metadata)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = []
+        self.closed = False
+        self.condition = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name="TripLogger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def log_trip(self, record):
+        """Queues a single `TripRecord` to be written"""
+        self.log_trips([record])
+
+    def log_trips(self, records):
+        """Queues several `TripRecord`s to be written"""
+        with self.condition:
+            if self.closed:
+                raise ValueError("Can't log trips once the logger has been closed")
+            self.records.extend(records)
+            if len(self.records) >= self.batch_size:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.records) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                records, self.records = self.records, []
+                closed = self.closed
+
+            if records:
+                self.writer.write(records)
+            if closed:
+                self.writer.close()
+                return
+
+    def close(self):
+        """Writes out any trips still in memory and stops the background thread.  Safe to call more than once"""
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        atexit.unregister(self.close)
@@ -0,0 +1,253 @@
+import argparse
+import csv
+import json
+import os
+import struct
+import time
+
+import numpy as np
+
+from constants import *
+
+# A trip store file is a header followed by any number of chunks, each holding a batch of trips column by column, and
+# run blocks, each starting the trips of another run appended to the file:
+#
+#   header: MAGIC, uint32 length of the metadata, JSON metadata, zero padding to a multiple of 8 bytes
+#   chunk:  CHUNK_MAGIC, uint32 number of rows, then each column as a contiguous little-endian array, zero padded to a
+#           multiple of 8 bytes
+#   run:    RUN_MAGIC, uint32 length of the metadata, JSON metadata of the run, zero padding to a multiple of 8 bytes
+#
+# The header's metadata describes the file and the first run.  Chunks and runs are only ever appended, so a run can
+# keep adding to the file and readers can memory-map it without parsing anything but the chunk and run headers.
+# Columns are ordered widest first so that every array stays aligned
+MAGIC = b'TRIPS\x00\x00\x01'
+CHUNK_MAGIC = b'CHNK'
+RUN_MAGIC = b'RUN\x00'
+COLUMNS = [
+    ('spawn_tick', np.dtype('<i8')),
+    ('arrival_tick', np.dtype('<i8')),
+    ('frames_waited_at_red_lights', np.dtype('<i4')),
+    ('trip_ticks', np.dtype('<i4')),
+    ('distance', np.dtype('<i4')),
+    ('method', np.dtype('u1')),
+]
+# Methods are stored as their index in this list
+METHODS = ["normal", "flocking"]
+# Order of the fields in a `trip_log.TripRecord`
+TRIP_FIELDS = ['frames_waited_at_red_lights', 'method', 'trip_ticks', 'distance', 'spawn_tick', 'arrival_tick']
+MISSING = -1  # Stored for fields that weren't recorded, e.g. in trips converted from the old CSV logs
+
+
+def pad_to_8(num_bytes):
+    return -num_bytes % 8
+
+
+class TripStoreWriter:
+    def __init__(self, filename, metadata=None):
+        """Appends the trips of a run to a trip store file, creating it (with `metadata` in its header) if it doesn't
+        exist yet.  When adding to an existing file, `metadata` goes in a run block ahead of the run's trips instead
+
+        :param filename: Trip store file
+        :param metadata: Dict of information about the run to keep with its trips
+        """
+        self.filename = filename
+        if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+            self.write_header(metadata or {})
+        else:
+            with open(filename, 'rb') as infile:
+                if infile.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f"{filename} isn't a trip store file")
+            self.write_run(metadata or {})
+
+    def write_header(self, metadata):
+        metadata = dict(metadata, created=metadata.get('created', time.time()),
+                        columns=[[name, dtype.str] for name, dtype in COLUMNS], methods=METHODS)
+        encoded = json.dumps(metadata).encode()
+        header_length = len(MAGIC) + 4 + len(encoded)
+        with open(self.filename, 'wb') as outfile:
+            outfile.write(MAGIC + struct.pack('<I', len(encoded)) + encoded + bytes(pad_to_8(header_length)))
+
+    def write_run(self, metadata):
+        """Starts another run in an existing file"""
+        encoded = json.dumps(dict(metadata, created=metadata.get('created', time.time()))).encode()
+        with open(self.filename, 'ab') as outfile:
+            outfile.write(RUN_MAGIC + struct.pack('<I', len(encoded)) + encoded + bytes(pad_to_8(8 + len(encoded))))
+
+    def write(self, records):
+        """Appends a batch of trips as a single chunk
+
+        :param records: Sequence of `TripRecord`s (or tuples with the same fields)
+        """
+        if not records:
+            return
+        columns = {name: [] for name, _ in COLUMNS}
+        for record in records:
+            for name, value in zip(TRIP_FIELDS, record):
+                columns[name].append(METHODS.index(value) if name == 'method' else value)
+
+        self.write_columns({name: np.asarray(values) for name, values in columns.items()})
+
+    def write_columns(self, columns):
+        """Appends a chunk straight from arrays, one per column, all of the same length
+
+        :param columns: Dict of column name -> array
+        """
+        num_rows = len(columns['method'])
+        with open(self.filename, 'ab') as outfile:
+            outfile.write(CHUNK_MAGIC + struct.pack('<I', num_rows))
+            for name, dtype in COLUMNS:
+                data = np.ascontiguousarray(columns[name], dtype=dtype).tobytes()
+                outfile.write(data + bytes(pad_to_8(len(data))))
+
+    def close(self):
+        """Nothing to do, as every chunk is written to disk straight away"""
+
+
+class TripStore:
+    def __init__(self, filename):
+        """Reads a trip store file through a memory map, so that even files with hundreds of millions of trips can be
+        summarized without reading them into memory
+
+        :param filename: Trip store file
+        """
+        self.filename = filename
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{filename} isn't a trip store file")
+
+        metadata_length, = struct.unpack('<I', bytes(self.data[len(MAGIC):len(MAGIC) + 4]))
+        metadata_start = len(MAGIC) + 4
+        self.metadata = json.loads(bytes(self.data[metadata_start:metadata_start + metadata_length]))
+        self.methods = self.metadata['methods']
+        self.first_chunk = metadata_start + metadata_length + pad_to_8(metadata_start + metadata_length)
+        # Metadata of each run in the file, starting with the header's
+        self.runs = [self.metadata] + [metadata for _, metadata in self.read_blocks() if metadata is not None]
+
+    def read_blocks(self):
+        """Yields `(offset, metadata)` for each block after the header, where `metadata` is the run's for a run block
+        and `None` for a chunk.  A block cut short (e.g. by a crash while it was being written) ends the file
+        """
+        offset = self.first_chunk
+        while offset + 8 <= len(self.data):
+            block_magic = bytes(self.data[offset:offset + 4])
+            length, = struct.unpack('<I', bytes(self.data[offset + 4:offset + 8]))
+            if block_magic == RUN_MAGIC:
+                if offset + 8 + length > len(self.data):
+                    return
+                yield offset, json.loads(bytes(self.data[offset + 8:offset + 8 + length]))
+                offset += 8 + length + pad_to_8(8 + length)
+            elif block_magic == CHUNK_MAGIC:
+                yield offset, None
+                offset += 8 + sum(length * dtype.itemsize + pad_to_8(length * dtype.itemsize) for _, dtype in COLUMNS)
+            else:
+                raise ValueError(f"Corrupt chunk header at byte {offset} of {self.filename}")
+
+    def chunks(self):
+        """Yields each chunk as a dict of column name -> array, along with 'run', the index in `self.runs` of the run
+        the trips are from.  The arrays are views into the memory map, so nothing is read until they're used
+        """
+        run = 0
+        for offset, metadata in self.read_blocks():
+            if metadata is not None:
+                run += 1
+                continue
+            num_rows, = struct.unpack('<I', bytes(self.data[offset + 4:offset + 8]))
+            offset += 8
+
+            chunk = {'run': run}
+            for name, dtype in COLUMNS:
+                num_bytes = num_rows * dtype.itemsize
+                if offset + num_bytes > len(self.data):
+                    return
+                chunk[name] = self.data[offset:offset + num_bytes].view(dtype)
+                offset += num_bytes + pad_to_8(num_bytes)
+            yield chunk
+
+    def __len__(self):
+        return sum(len(chunk['method']) for chunk in self.chunks())
+
+    def column(self, name):
+        """Reads a whole column into memory
+
+        :param name: Name of the column
+        :return:     Array of the column's values
+        """
+        return np.concatenate([chunk[name] for chunk in self.chunks()] or [np.zeros(0, dtype=dict(COLUMNS)[name])])
+
+    def aggregate_by_method(self, column='frames_waited_at_red_lights'):
+        """Works out the count, mean and standard deviation of a column for each method, a chunk at a time.  Missing
+        values are left out
+
+        :param column: Name of the column to summarize
+        :return:       Dict of method -> dict of 'count', 'mean' and 'std'
+        """
+        counts = np.zeros(len(self.methods), dtype=np.int64)
+        sums = np.zeros(len(self.methods), dtype=np.float64)
+        sums_of_squares = np.zeros(len(self.methods), dtype=np.float64)
+        for chunk in self.chunks():
+            present = chunk[column] != MISSING
+            methods = chunk['method'][present]
+            values = chunk[column][present].astype(np.float64)
+            counts += np.bincount(methods, minlength=len(self.methods))
+            sums += np.bincount(methods, weights=values, minlength=len(self.methods))
+            sums_of_squares += np.bincount(methods, weights=values * values, minlength=len(self.methods))
+
+        summary = {}
+        for method_code, method_name in enumerate(self.methods):
+            if counts[method_code] == 0:
+                continue
+            mean = sums[method_code] / counts[method_code]
+            variance = max(sums_of_squares[method_code] / counts[method_code] - mean * mean, 0.0)
+            summary[method_name] = {'count': int(counts[method_code]), 'mean': float(mean),
+                                    'std': float(variance ** 0.5)}
+        return summary
+
+
+def convert_csv(csv_filename, store_filename, batch_size=65536):
+    """Converts a CSV trip log (like `waiting_times.csv`) to a trip store.  Old rows only have the frames waited at
+    red lights and the method; the other fields are stored as `MISSING`
+
+    :param csv_filename:   CSV trip log to read
+    :param store_filename: Trip store to append the trips to
+    :param batch_size:     Number of rows per chunk
+    :return:               Number of trips converted
+    """
+    writer = TripStoreWriter(store_filename, metadata={'converted_from': os.path.basename(csv_filename)})
+    num_trips = 0
+    batch = []
+    with open(csv_filename, newline='') as infile:
+        for row in csv.reader(infile):
+            if not row:
+                continue
+            row = row + [MISSING] * (len(TRIP_FIELDS) - len(row))
+            batch.append([row[1] if name == 'method' else int(value) for name, value in zip(TRIP_FIELDS, row)])
+            if len(batch) >= batch_size:
+                writer.write(batch)
+                num_trips += len(batch)
+                batch = []
+    writer.write(batch)
+    return num_trips + len(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Converts and summarizes trip store files")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help="Convert a CSV trip log to a trip store")
+    convert_parser.add_argument('csv_file', nargs='?', default=logfile_name)
+    convert_parser.add_argument('store_file')
+    summary_parser = subparsers.add_parser('summary', help="Summarize the trips in a trip store by method")
+    summary_parser.add_argument('store_file')
+    summary_parser.add_argument('--column', default='frames_waited_at_red_lights',
+                                choices=[name for name, _ in COLUMNS if name != 'method'])
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        print(f"Converted {convert_csv(args.csv_file, args.store_file)} trips")
+    else:
+        store = TripStore(args.store_file)
+        for method_name, stats in store.aggregate_by_method(args.column).items():
+            print(f"{method_name}: {stats['count']} trips, mean {stats['mean']:.3f}, std {stats['std']:.3f}")
+
+
+if __name__ == '__main__':
+    main()
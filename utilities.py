@@ -8,4 +8,14 @@ def distance(start_pos, finish_pos):
     :param finish_pos: Finishing position
     :return:           Distance between the two positions
     """
-    return math.sqrt(pow(finish_pos['x'] - start_pos['x'], 2) + pow(finish_pos['y'] - start_pos['y'], 2))
+    return math.sqrt(pow(finish_pos[0] - start_pos[0], 2) + pow(finish_pos[1] - start_pos[1], 2))
+
+
+def manhattan_distance(start_pos, finish_pos):
+    """Helper function to get the distance between two locations when only driving along the grid
+
+    :param start_pos:  Starting position
+    :param finish_pos: Finishing position
+    :return:           Distance between the two positions
+    """
+    return abs(finish_pos[0] - start_pos[0]) + abs(finish_pos[1] - start_pos[1])
@@ -1,7 +1,9 @@
-import warnings, csv
+from itertools import count
 
 from city_map import *
 
+vehicle_ids = count()  # Used to tell the cars apart in the map's occupancy grid
+
 all_directions = [UP, DOWN, LEFT, RIGHT]
 # For easily reasoning about turns
 direction_to_left = {UP: LEFT, RIGHT: UP, DOWN: RIGHT, LEFT: DOWN}
@@ -10,83 +12,111 @@ direction_backwards = {UP: DOWN, LEFT: RIGHT, DOWN: UP, RIGHT: LEFT}
 
 
 class Vehicle:
-    def __init__(self, car_body_color, car_outline_color, city_map):
-        self.position = city_map.get_random_road_tile_position()
-        self.destination = city_map.get_random_road_tile_position()
+    # Cars are created and destroyed all the time and there can be a lot of them, so don't give each one a `__dict__`
+    __slots__ = ('position', 'destination', 'previous_position', 'direction', 'city_map', 'id', 'exit_tile', 'path',
+                 'original_path', 'body_color', 'outline_color', 'destination_reached', 'frames_waited_at_red_lights',
+                 'velocity', 'method', 'spawn_tick', 'distance_travelled', 'ticks_blocked', 'asleep_since',
+                 'red_light_frames_per_tick')
+
+    def __init__(self, car_body_color, car_outline_color, city_map, method=method, spawn_tick=0, position=None,
+                 streams=None):
+        """Creates a car on a free road tile of the map and plans its route to a random destination
+
+        :param car_body_color:    Color of the car
+        :param car_outline_color: Color of the car's outline
+        :param city_map:          `Map` object to drive on
+        :param method:            Navigation method, either "normal" or "flocking"
+        :param spawn_tick:        Simulation tick on which the car is created
+        :param position:          `(x, y)` to start from.  If not given, a random free road tile is picked.  The map must
+                                  have a free road tile either way (see `Map.free_road_tiles`)
+        :param streams:           `RandomStreams` to pick the start and destination with, the map's by default
+        """
+        if streams is None:
+            streams = city_map.streams
+        if position is None:
+            position = city_map.get_free_road_tile_position(streams.spawn)
+        self.position = position
+        self.destination = city_map.get_random_road_tile_position(streams.destinations)
         self.previous_position = None
         self.direction = RIGHT
         self.city_map = city_map  # Used for reasoning about navigation
+        self.id = next(vehicle_ids)
+        self.city_map.vehicles[self.id] = self
+        self.exit_tile = None  # Only used with a routing table; the intersection at which we leave the network
         self.path = self.get_path()
-        self.original_path = deepcopy(self.path)
-
-        self.turn_to_direction_map = {UP: self.go_up, RIGHT: self.go_right, DOWN: self.go_down, LEFT: self.go_left}
+        self.original_path = list(self.path)  # Not a deep copy, since that would copy the tiles and the whole map
+        self.direction = self.get_starting_direction()
 
         self.body_color = car_body_color
         self.outline_color = car_outline_color
         self.destination_reached = False
         self.frames_waited_at_red_lights = 0
         self.velocity = 1
+        self.method = method  # Either "normal" or "flocking"
+        self.spawn_tick = spawn_tick  # Simulation tick on which the car was created
+        self.distance_travelled = 0  # Number of tiles the car has moved
+        self.ticks_blocked = 0  # Number of ticks in a row on which the car failed to move, in event-driven mode
+        self.asleep_since = None  # Tick of the last call to `move` before the car fell asleep, if it's asleep
+        self.red_light_frames_per_tick = 0  # Frames the car would wait at a red light on every tick it's asleep
+
+        # Take the tile straight away, so that no other car gets put on top of us
+        self.city_map.add_car(self, self.position)
 
     def get_path(self):
-        """This is ugly and unsophisticated, but it gets the cars to their goals.  Besides, the point of my project is
-        not to implement an efficient path-finding algorithm, it's to augment autonomous vehicles to be more cooperative
+        """Plans the car's route.  The part between intersections is shared between cars through the map's route cache,
+        so the car only has to work out how to get from its starting tile onto the intersection network and how to get
+        from the network to its destination tile.  If the map has a routing table, the path only goes as far as the
+        first intersection, and `advance_waypoint` looks up each following one as the car gets there
 
         :return: The series of intersections to travel through to reach the car's destination
         """
-        path = [self.city_map.get_tile_at_position(self.position)]
+        start_tile = self.city_map.get_tile_at_position(self.position)
         destination_tile = self.city_map.get_tile_at_position(self.destination)
+        start_neighbors = self.city_map.get_adjacent_intersections(self.position)
+        destination_neighbors = self.city_map.get_adjacent_intersections(self.destination)
+
+        path = [start_tile]
+
+        # If we start and finish on the same block, we can just drive straight there
+        if not self.city_map.is_intersection(self.position) and not self.city_map.is_intersection(self.destination) \
+                and set(start_neighbors) == set(destination_neighbors):
+            if destination_tile is not start_tile:
+                path.append(destination_tile)
+            return path
+
+        # We can get onto the intersection network at either end of the block we start on, and leave it at either end
+        # of the destination's block, so pick whichever combination is shortest overall
+        entry_tiles = [start_tile] if self.city_map.is_intersection(self.position) else start_neighbors
+        exit_tiles = [destination_tile] if self.city_map.is_intersection(self.destination) else destination_neighbors
+        entry_tile, exit_tile = min(
+            ((entry_tile, exit_tile) for entry_tile in entry_tiles for exit_tile in exit_tiles),
+            key=lambda tiles: (manhattan_distance(self.position, tiles[0].position) +
+                               self.city_map.get_route_length(*tiles) +
+                               manhattan_distance(tiles[1].position, self.destination)))
+
+        if self.city_map.routing_table is not None:
+            self.exit_tile = exit_tile
+            route = (entry_tile, destination_tile) if entry_tile is exit_tile else (entry_tile,)
+        else:
+            route = self.city_map.get_route(entry_tile, exit_tile) + (destination_tile,)
 
-        neighbors = self.city_map.get_adjacent_intersections(self.position)
-        closest_neighbor = None
-        closest_neighbor_distance = math.inf
-        for neighbor in neighbors:
-            if distance(neighbor.position, self.position) < closest_neighbor_distance:
-                closest_neighbor = neighbor
-                closest_neighbor_distance = distance(neighbor.position, self.position)
-
-        path.append(closest_neighbor)
-
-        while destination_tile not in path:
-            current_tile = path[-1]
-            neighbors = self.city_map.get_adjacent_intersections(current_tile.position)
-            closest_neighbor = None
-            closest_neighbor_distance = math.inf
-            for neighbor in neighbors:
-                if current_tile.position['y'] == self.destination['y'] or current_tile.position['x'] == \
-                        self.destination['x']:
-                    # If we're on the same row
-                    if current_tile.position['y'] == self.destination['y']:
-                        # And if the destination is between our current position and the next intersection over, go to it
-                        if (current_tile.position['x'] < self.destination['x'] <= neighbor.position['x'] or
-                                neighbor.position['x'] <= self.destination['x'] < current_tile.position['x']):
-                            path.append(destination_tile)
-                            break
-                        # If the neighbor gets us closer, go to it
-                        elif distance(neighbor.position, self.destination) < distance(current_tile.position,
-                                                                                      self.destination):
-                            path.append(neighbor)
-                            break
-                    if current_tile.position['x'] == self.destination['x']:
-                        if (current_tile.position['y'] < self.destination['y'] <= neighbor.position['y'] or
-                                neighbor.position['y'] <= self.destination['y'] < current_tile.position['y']):
-                            path.append(destination_tile)
-                            break
-                        # If the neighbor gets us closer, go to it
-                        elif distance(neighbor.position, self.destination) < distance(current_tile.position,
-                                                                                      self.destination):
-                            path.append(neighbor)
-                            break
-
-                elif distance(neighbor.position, self.destination) < closest_neighbor_distance:
-                    closest_neighbor = neighbor
-                    closest_neighbor_distance = distance(neighbor.position, self.destination)
-
-            # If the last iteration through the loop did reach the destination, don't append this
-            if destination_tile not in path and closest_neighbor is not None:
-                path.append(closest_neighbor)
+        for tile in route:
+            if tile is not path[-1]:
+                path.append(tile)
 
         return path
 
+    def advance_waypoint(self):
+        """Drops the waypoint we've just reached.  When following a routing table, this is also where the next
+        intersection gets looked up
+        """
+        reached_tile = self.path.pop(0)
+        if not self.path and self.exit_tile is not None:
+            if reached_tile is self.exit_tile:
+                self.path = [self.city_map.get_tile_at_position(self.destination)]
+            else:
+                self.path = [self.city_map.get_next_hop(reached_tile, self.exit_tile)]
+
     def get_direction_to_left(self, direction):
         """Gets the direction to the left of the car, from the perspective of the direction that the car is facing.
         E.g., if the car is facing UP, this will return LEFT, and if it's facing DOWN, this will return RIGHT
@@ -114,29 +144,31 @@ class Vehicle:
         """
         return direction_backwards[direction]
 
+    # Positions are immutable tuples, and every tile already has one, so moving never needs to copy or build one
     def go_up(self):
-        self.previous_position = deepcopy(self.position)
-        # self.position['y'] -= 1
+        self.previous_position = self.position
         self.direction = UP
-        self.position = {'x': self.position['x'], 'y': self.position['y'] - 1}
+        self.position = self.city_map.get_tile_up(self.position).position
 
     def go_down(self):
-        self.previous_position = deepcopy(self.position)
-        # self.position['y'] += 1
+        self.previous_position = self.position
         self.direction = DOWN
-        self.position = {'x': self.position['x'], 'y': self.position['y'] + 1}
+        self.position = self.city_map.get_tile_down(self.position).position
 
     def go_right(self):
-        self.previous_position = deepcopy(self.position)
-        # self.position['x'] += 1
+        self.previous_position = self.position
         self.direction = RIGHT
-        self.position = {'x': self.position['x'] + 1, 'y': self.position['y']}
+        self.position = self.city_map.get_tile_right(self.position).position
 
     def go_left(self):
-        self.previous_position = deepcopy(self.position)
-        # self.position['x'] -= 1
+        self.previous_position = self.position
         self.direction = LEFT
-        self.position = {'x': self.position['x'] - 1, 'y': self.position['y']}
+        self.position = self.city_map.get_tile_left(self.position).position
+
+    # Shared by all cars rather than building a dict of bound methods for each one
+    turn_to_direction_map = {UP: go_up, RIGHT: go_right, DOWN: go_down, LEFT: go_left}
+    tile_in_direction_map = {UP: Map.get_tile_up, RIGHT: Map.get_tile_right, DOWN: Map.get_tile_down,
+                             LEFT: Map.get_tile_left}
 
     def move_in_direction(self, direction, next_tile, previous_tile):
         """Moves the car in the desired direction.  When this method is called, the car should already be certain that
@@ -150,21 +182,24 @@ class Vehicle:
         # for ii in range(self.velocity):
         # Don't run over any cars or blow through traffic lights
         if self.can_move_to_tile(next_tile):
-            self.turn_to_direction_map[direction]()  # Adding the parentheses actually calls the method
-            next_tile.add_car(self)
-            previous_tile.remove_car(self)
+            previous_direction = self.direction
+            self.turn_to_direction_map[direction](self)  # Adding the parentheses actually calls the method
+            self.city_map.add_car(self, next_tile.position)
+            self.city_map.remove_car(self, previous_tile.position, previous_direction)
+            self.distance_travelled += 1
             if self.destination == self.position:
                 self.destination_reached = True
         else:  # if we didn't move, update previous position to be current position
             # TODO: change `self.go_up()` and other movement methods to not update `self.previous_position` so that we
             #       only do it once here
-            self.previous_position = deepcopy(self.position)
+            self.previous_position = self.position
 
     def destroy(self):
-        """To be called by the main simulator when the car reaches its destination.  It removes the car from the tile
-        objects so that other cars can continue on their way
+        """To be called by the main simulator when the car reaches its destination.  It removes the car from the map so
+        that other cars can continue on their way
         """
-        self.city_map.get_tile_at_position(self.position).car = None
+        self.city_map.remove_car(self, self.position)
+        del self.city_map.vehicles[self.id]
 
     def can_move_to_tile(self, tile):
         """Checks that the tile can be moved onto
@@ -173,13 +208,12 @@ class Vehicle:
         :return:     Bool, `True` if car can move onto tile, `False` otherwise
         """
         try:
-            if tile in [self.get_tile_in_direction(direction, self.city_map) for direction in all_directions]:
+            # Only tiles right next to us can be moved onto
+            if manhattan_distance(tile.position, self.position) == 1:
                 if tile.is_road:
                     if tile.light is None or tile.light.get_light_for_direction_of_travel(self.direction) != LightColor.red:
-                        if not tile.car:
-                            return True
                         # For simplicity, each tile represents a whole road (i.e., traffic in both directions)
-                        elif tile.car.direction != self.direction:
+                        if not self.city_map.has_car_going(tile.position, self.direction):
                             return True
                     elif tile.light.get_light_for_direction_of_travel(self.direction) == LightColor.red:
                         self.frames_waited_at_red_lights += 1
@@ -191,60 +225,127 @@ class Vehicle:
             pass
 
     def get_tile_in_direction(self, direction, city_map):
-        if direction == UP:
-            return city_map.get_tile_up(self.position)
-        elif direction == RIGHT:
-            return city_map.get_tile_right(self.position)
-        elif direction == DOWN:
-            return city_map.get_tile_down(self.position)
-        elif direction == LEFT:
-            return city_map.get_tile_left(self.position)
+        return self.tile_in_direction_map[direction](city_map, self.position)
 
     def move(self, city_map):
-        # Yes, I know we do this below, but we need to check it here as well.  I know it's ugly, but it works
-        if self.position == self.path[0].position:
-            self.path = self.path[1:]  # We've reached the next intersection, so we no longer need it as a waypoint
-        elif self.position == self.destination:
+        # Yes, I know we do this below, but we need to check it here as well.  I know it's ugly, but it works.  The
+        # destination is checked first, since it's also the last waypoint and we'd otherwise run out of waypoints
+        if self.position == self.destination:
             self.destination_reached = True
             return
+        elif self.position == self.path[0].position:
+            self.advance_waypoint()  # We've reached the next intersection, so we no longer need it as a waypoint
 
         self.velocity = self.get_velocity()
         for ii in range(self.velocity):
-            new_direction = self.direction  # Initialize `new_direction` so it's not `None` when we need to access it
-            if self.position == self.path[0].position:
-                self.path = self.path[1:]  # We've reached the next intersection, so we no longer need it as a waypoint
-            elif self.position == self.destination:
+            if self.position == self.destination:
                 self.destination_reached = True
                 return
+            elif self.position == self.path[0].position:
+                self.advance_waypoint()  # We've reached the next intersection, so we no longer need it as a waypoint
 
-            # If we're on the right column for the next waypoint...
-            if self.path[0].position['x'] == self.position['x']:
-                # If next waypoint is up...
-                if self.path[0].position['y'] < self.position['y']:
-                    new_direction = UP
-                # If next waypoint is down...
-                elif self.position['y'] < self.path[0].position['y']:
-                    new_direction = DOWN
-
-            # ...or maybe we're on the right row instead...
-            elif self.path[0].position['y'] == self.position['y']:
-                # If next waypoint is left...
-                if self.path[0].position['x'] < self.position['x']:
-                    new_direction = LEFT
-                # If next waypoint is right...
-                elif self.position['x'] < self.path[0].position['x']:
-                    new_direction = RIGHT
-
+            new_direction = self.get_direction_to_waypoint()
             current_tile = city_map.get_current_tile(self.position)
             proposed_tile = self.get_tile_in_direction(new_direction, city_map)
             self.move_in_direction(new_direction, proposed_tile, current_tile)
 
-    def get_velocity(self):
-        if method != "flocking":
+    def get_direction_to_waypoint(self, waypoint=None):
+        """Gets the direction to head in to reach the next waypoint along its row or column.  If we're on neither, we
+        keep going the same way
+
+        :param waypoint: Tile to head for instead of the next waypoint
+        """
+        if waypoint is None:
+            waypoint = self.path[0]
+        new_direction = self.direction
+        # If we're on the right column for the next waypoint...
+        if waypoint.position[0] == self.position[0]:
+            # If next waypoint is up...
+            if waypoint.position[1] < self.position[1]:
+                new_direction = UP
+            # If next waypoint is down...
+            elif self.position[1] < waypoint.position[1]:
+                new_direction = DOWN
+
+        # ...or maybe we're on the right row instead...
+        elif waypoint.position[1] == self.position[1]:
+            # If next waypoint is left...
+            if waypoint.position[0] < self.position[0]:
+                new_direction = LEFT
+            # If next waypoint is right...
+            elif self.position[0] < waypoint.position[0]:
+                new_direction = RIGHT
+        return new_direction
+
+    def get_starting_direction(self):
+        """Gets the direction a new car sets off in, which is the direction it holds its starting tile in until then.
+        Facing any other way would block cars going that way instead, and two new cars that each want the other's tile
+        would block each other for good
+        """
+        for tile in self.path:
+            if tile.position != self.position:
+                return self.get_direction_to_waypoint(tile)
+        if self.exit_tile is not None and self.path[0] is not self.exit_tile:
+            # Following a routing table from the start, so the second waypoint hasn't been looked up yet
+            return self.get_direction_to_waypoint(self.city_map.get_next_hop(self.path[0], self.exit_tile))
+        return self.direction
+
+    def fall_asleep(self, tick):
+        """Puts a car that failed to move on its last try to sleep until whatever is in its way changes, so that the
+        simulation doesn't have to call `move` on it every tick.  Until then, every call to `move` would fail the same
+        way, so all it would do is count the frames spent at a red light, which `wake_up` credits in one go.  The car
+        is woken through the map's `woken_cars` when the tile it's trying to move onto or the light on it changes.  In
+        flocking mode, cars at a red light are also woken when a tile ahead changes, since the number of cars ahead
+        decides how many frames per tick they wait
+
+        :param tick: Simulation tick on which the car failed to move
+        :return:     `True` if the car fell asleep
+        """
+        city_map = self.city_map
+        tile = self.get_tile_in_direction(self.get_direction_to_waypoint(), city_map)
+        self.red_light_frames_per_tick = 0
+        if tile is None or not tile.is_road or manhattan_distance(tile.position, self.position) != 1:
+            pass  # We're never getting off this tile, so nothing needs to wake us up
+        elif tile.light is not None and tile.light.get_light_for_direction_of_travel(self.direction) == LightColor.red:
+            # The cars ahead are counted at the start of every tick we sleep through, and until one of the tiles ahead
+            # changes, they'll be counted as they are now
+            self.red_light_frames_per_tick = self.get_velocity(
+                city_map.count_cars_between(self.position, self.path[0].position))
+            city_map.cars_sleeping_on_light.setdefault(tile.position, set()).add(self)
+            if self.method == "flocking":
+                for position in city_map.get_positions_between(self.position, self.path[0].position):
+                    city_map.cars_sleeping_on_tile.setdefault(position, set()).add(self)
+        elif city_map.has_car_going(tile.position, self.direction):
+            city_map.cars_sleeping_on_tile.setdefault(tile.position, set()).add(self)
+            if tile.light is not None:
+                # The light might turn red before the tile frees up, and then we'd start counting frames
+                city_map.cars_sleeping_on_light.setdefault(tile.position, set()).add(self)
+        else:
+            return False
+        self.asleep_since = tick
+        return True
+
+    def wake_up(self, tick):
+        """Wakes up a car put to sleep by `fall_asleep`, crediting it with the frames it would have waited at a red
+        light on the ticks it slept through
+
+        :param tick: Simulation tick on which the car moves next
+        """
+        self.frames_waited_at_red_lights += self.red_light_frames_per_tick * (tick - self.asleep_since - 1)
+        self.asleep_since = None
+
+    def get_velocity(self, num_cars_ahead=None):
+        """Gets how many tiles to try to move this tick
+
+        :param num_cars_ahead: Number of cars between us and the next waypoint.  By default, they're counted as of the
+                               start of the tick (see `Map.count_cars_ahead`)
+        """
+        if self.method != "flocking":
             return 1
-        cars_ahead = self.get_cars_between_me_and_next_intersection()
+        if num_cars_ahead is None:
+            num_cars_ahead = self.city_map.count_cars_ahead(self.position, self.path[0].position)
 
-        if len(cars_ahead) > 0:
+        if num_cars_ahead > 0:
             return 2  # Go slightly faster, but not excessively faster (there are still speed limits and stuff)
         else:
             return 1
@@ -259,48 +360,9 @@ class Vehicle:
         :return: List of the cars which we can flock to
         """
         next_intersection_tile = self.path[0]
-
-        tiles = self.city_map.get_tiles_between_tile_a_and_tile_b(self.city_map.get_tile_at_position(self.position),
-                                                                  next_intersection_tile)
-
-        cars = []
-        for tile in tiles:
-            if tile.car is not None:
-                cars.append(tile.car)
-
-        return cars
-
-    def draw(self):
-        x = self.position['x'] * CELLSIZE
-        y = self.position['y'] * CELLSIZE
-        car_rect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
-        pygame.draw.rect(DISPLAYSURF, self.outline_color, car_rect)
+        car_ids = self.city_map.get_car_ids_between(self.position, next_intersection_tile.position)
+        return [self.city_map.vehicles[car_id] for car_id in car_ids]
 
     # def explode(self):
     #     # print("BOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOOM!!!!!!")
     #     pass
-
-    def __del__(self):
-        # warnings.warn("RE-ENABLE LOGGING!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-
-        print("DESTROYING CAR")
-        self.position = None
-        self.destination = None
-        self.previous_position = None
-        self.direction = None
-        self.city_map = None
-        self.path = None
-        self.original_path = None
-
-        self.turn_to_direction_map = None
-
-        self.body_color = None
-        self.outline_color = None
-        self.destination_reached = None
-
-        print(f"Frames spent waiting at red lights: {self.frames_waited_at_red_lights}")
-        with open(logfile_name, 'a') as outfile:
-            writer = csv.writer(outfile, delimiter=',')
-            writer.writerow([self.frames_waited_at_red_lights, method])
-        self.frames_waited_at_red_lights = None
-
@@ -4,16 +4,38 @@
 # Released under a "Simplified BSD" license
 
 import sys
-from vehicle_agent import Vehicle
-from city_map import Map, make_map
+import time
+import pygame
+from simulation import Simulation
+from renderer import Renderer
+from instrumentation import Instrumentation, NO_INSTRUMENTATION
+from trip_log import TripLogger
 from constants import *
 from pygame.locals import *
 
+TRIP_LOGGER = None
+INSTRUMENTATION = NO_INSTRUMENTATION
+
+CAPTION = 'ALASKAN BULL WORMS!!!!!'
+# Simulation ticks per 1/FPS seconds for each speed hotkey; `None` runs as many ticks as fit in a frame
+SPEED_KEYS = {K_1: 1, K_2: 10, K_3: None}
+# Ticks owed beyond this are dropped, so that a machine that can't keep up doesn't fall further and further behind
+MAX_TICKS_PER_FRAME = 1000
+
 
 def main():
-    global FPSCLOCK, DISPLAYSURF, BASICFONT
+    global FPSCLOCK, DISPLAYSURF, BASICFONT, TRIP_LOGGER, INSTRUMENTATION
+
+    # Only the windowed front end needs pygame; `Simulation` runs fine without it
+    pygame.init()
+    FPSCLOCK = pygame.time.Clock()
+    DISPLAYSURF = pygame.display.set_mode((WINDOWWIDTH, WINDOWHEIGHT))
+    BASICFONT = pygame.font.Font('freesansbold.ttf', 18)
+    TRIP_LOGGER = TripLogger(logfile_name)
+    if INSTRUMENT:
+        INSTRUMENTATION = Instrumentation(output=INSTRUMENTATION_FILE, dump_interval=INSTRUMENTATION_WINDOW)
 
-    pygame.display.set_caption('ALASKAN BULL WORMS!!!!!')
+    pygame.display.set_caption(CAPTION)
 
     # show_start_screen()
     while True:
@@ -21,42 +43,83 @@ def main():
 
 
 def run_game():
-    city_map = make_map()
-
-    cars = []
-    for i in range(NUM_CARS):
-        cars.append(Vehicle(ORANGE, DARKORANGE, city_map))
+    """Runs the simulation in the window.  The simulation advances in fixed ticks, independently of how often frames
+    are drawn, so the run is the same whatever the speed.  Hotkeys:
+
+    - 1, 2 and 3: run at 1x (FPS ticks a second), 10x, or as fast as possible
+    - space: pause or resume
+    - S: advance by a single tick while paused
+    - R: stop or start drawing frames, e.g. to fast-forward to an interesting moment
+    """
+    simulation = Simulation(trip_logger=TRIP_LOGGER, instrumentation=INSTRUMENTATION)
+    renderer = Renderer(DISPLAYSURF, instrumentation=INSTRUMENTATION)
+    phase = INSTRUMENTATION.phase
+
+    speed = 1
+    paused = False
+    rendering = True
+    ticks_owed = 0.0  # Ticks due at the current speed that haven't been run yet
+    single_steps = 0
+    last_frame_time = time.perf_counter()
+    last_caption_time = 0.0
 
     while True:  # main game loop
-        for event in pygame.event.get():  # event handling loop
-            if event.type == QUIT:
-                terminate()
-            elif event.type == KEYDOWN:
-                if event.key == K_ESCAPE:
+        with phase('events'):
+            for event in pygame.event.get():  # event handling loop
+                if event.type == QUIT:
                     terminate()
-
-        for car in cars:
-            car.move(city_map)
-            if car.destination_reached:
-                car.destroy()
-                cars.remove(car)
-                del car
-
-                # # Create a new car in its stead
-                cars.append(Vehicle(ORANGE, DARKORANGE, city_map))
-
-        DISPLAYSURF.fill(BGCOLOR)
-        draw_grid(city_map)
-
-        city_map.draw_lights()
-
-        for car in cars:
-            car.draw()
-
-        city_map.update_traffic_lights()
-
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+                elif event.type == KEYDOWN:
+                    if event.key == K_ESCAPE:
+                        terminate()
+                    elif event.key in SPEED_KEYS:
+                        speed = SPEED_KEYS[event.key]
+                    elif event.key == K_SPACE:
+                        paused = not paused
+                    elif event.key == K_s:
+                        single_steps += 1
+                    elif event.key == K_r:
+                        rendering = not rendering
+
+        frame_start_time = time.perf_counter()
+        if paused:
+            ticks_owed = 0.0
+            for _ in range(single_steps):
+                step(simulation)
+        elif speed is None:
+            # Use up the whole frame, leaving just enough time to draw it
+            while time.perf_counter() - frame_start_time < 1 / FPS:
+                step(simulation)
+        else:
+            ticks_owed = min(ticks_owed + (frame_start_time - last_frame_time) * FPS * speed, MAX_TICKS_PER_FRAME)
+            for _ in range(int(ticks_owed)):
+                step(simulation)
+            ticks_owed -= int(ticks_owed)
+        single_steps = 0
+        last_frame_time = frame_start_time
+
+        if rendering:
+            renderer.draw(simulation)
+            with phase('display update'):
+                pygame.display.update()
+        if frame_start_time - last_caption_time > 0.5:
+            pygame.display.set_caption(get_caption(simulation, speed, paused, rendering))
+            last_caption_time = frame_start_time
+        # Only fast-forwarding without drawing runs flat out
+        if rendering or paused or speed is not None:
+            with phase('frame wait'):
+                FPSCLOCK.tick(FPS)
+
+
+def step(simulation):
+    simulation.step()
+    INSTRUMENTATION.end_tick()
+
+
+def get_caption(simulation, speed, paused, rendering):
+    state = "paused" if paused else ("max speed" if speed is None else f"{speed}x")
+    if not rendering:
+        state += ", not drawing"
+    return f"{CAPTION} - tick {simulation.tick_count}, {state}"
 
 
 def draw_press_key_msg():
@@ -109,6 +172,10 @@ def show_start_screen():
 
 
 def terminate():
+    # Make sure none of the completed trips get lost
+    if TRIP_LOGGER is not None:
+        TRIP_LOGGER.close()
+    INSTRUMENTATION.close()
     pygame.quit()
     sys.exit()
 
@@ -117,21 +184,5 @@ def terminate():
 #     return {'x': random.randint(0, CELLWIDTH - 1), 'y': random.randint(0, CELLHEIGHT - 1)}
 
 
-def draw_grid(city_map):
-    for tile_row in city_map.tiles:
-        for tile in tile_row:
-            x = tile.position['x'] * CELLSIZE
-            y = tile.position['y'] * CELLSIZE
-
-            tile_rect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
-            pygame.draw.rect(DISPLAYSURF, TILE, tile_rect)
-
-            obstacle_or_dirt_rect = pygame.Rect(x, y, CELLSIZE, CELLSIZE)
-            if tile.is_road:
-                pygame.draw.rect(DISPLAYSURF, FURNITURE, obstacle_or_dirt_rect)
-
-            pygame.draw.rect(DISPLAYSURF, GRAY, tile_rect, 1)  # 1 is the width of the rectangles' outline
-
-
 if __name__ == '__main__':
     main()